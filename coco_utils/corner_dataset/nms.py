@@ -0,0 +1,394 @@
+"""
+    nms backends for merging detections of sub images on CPU, without building the _C extension of
+    maskrcnn_benchmark. all backends follow the rule of maskrcnn_benchmark nms (float32, area with +1,
+    suppressed while iou >= iou_th), so they keep the same boxes.
+    a backend is func(boxes, starts, iou_th) => keep mask, boxes (N, 4) float32 xyxy are sorted by group and then
+    by score (high first), group g is boxes[starts[g]:starts[g+1]].
+    batched_soft_nms and batched_wbf merge the overlapped boxes instead of removing them, the clustering of
+    batched_wbf has numpy and numba backends too.
+"""
+import time
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import numba
+except ImportError as e:
+    numba = None
+
+
+NMS_BACKENDS = OrderedDict()
+# auto selection takes the first registered one, numba is the fastest in benchmark_nms_backends,
+# torch needs the compiled _C extension, so it is only used while given by name.
+AUTO_NMS_BACKENDS = ['numba', 'numpy']
+
+
+def register_nms_backend(name):
+    def register(func):
+        NMS_BACKENDS[name] = func
+        return func
+    return register
+
+
+def get_nms_backend(backend='auto'):
+    if backend == 'auto':
+        backend = [name for name in AUTO_NMS_BACKENDS if name in NMS_BACKENDS][0]
+    assert backend in NMS_BACKENDS, "nms backend must be 'auto' or one of {}, but got {}".format(
+        list(NMS_BACKENDS.keys()), backend)
+    return NMS_BACKENDS[backend]
+
+
+# weighted boxes fusion assigns each box to a cluster one by one, a backend is
+# func(boxes, scores, starts, iou_th) => cluster id of each box, boxes and scores are sorted as nms backends.
+WBF_BACKENDS = OrderedDict()
+
+
+def register_wbf_backend(name):
+    def register(func):
+        WBF_BACKENDS[name] = func
+        return func
+    return register
+
+
+def get_wbf_backend(backend='auto'):
+    if backend == 'auto':
+        backend = [name for name in AUTO_NMS_BACKENDS if name in WBF_BACKENDS][0]
+    assert backend in WBF_BACKENDS, "wbf backend must be 'auto' or one of {}, but got {}".format(
+        list(WBF_BACKENDS.keys()), backend)
+    return WBF_BACKENDS[backend]
+
+
+def _box_areas(boxes):
+    return (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+
+
+def _ious_of_one(boxes, areas, i, others):
+    """
+        iou between boxes[i] and boxes[others], area with +1 as nms of maskrcnn_benchmark
+    """
+    box, others_boxes = boxes[i], boxes[others]
+    w = np.maximum(np.minimum(box[2], others_boxes[:, 2]) - np.maximum(box[0], others_boxes[:, 0]) + 1, 0)
+    h = np.maximum(np.minimum(box[3], others_boxes[:, 3]) - np.maximum(box[1], others_boxes[:, 1]) + 1, 0)
+    inter = w * h
+    return inter / (areas[i] + areas[others] - inter)
+
+
+def _nms_of_sorted(boxes, iou_th):
+    """
+        greedy nms of boxes sorted by score (high first), each kept box suppresses all remained boxes at once,
+        return indices of kept boxes in sorted boxes.
+    """
+    areas = _box_areas(boxes)
+    iou_th = np.float32(iou_th)
+    order = np.arange(len(boxes))
+    keep = []
+    while len(order) > 0:
+        i, order = order[0], order[1:]
+        keep.append(i)
+        ious = _ious_of_one(boxes, areas, i, order)
+        order = order[ious < iou_th]
+    return np.array(keep, dtype=np.int64)
+
+
+@register_nms_backend('numpy')
+def _numpy_batched_nms(boxes, starts, iou_th):
+    keep = np.zeros((len(boxes),), dtype=bool)
+    for start, end in zip(starts[:-1], starts[1:]):
+        keep[start + _nms_of_sorted(boxes[start:end], iou_th)] = True
+    return keep
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _numba_batched_nms(boxes, starts, iou_th):
+        iou_th = np.float32(iou_th)
+        one, zero = np.float32(1), np.float32(0)
+        areas = (boxes[:, 2] - boxes[:, 0] + one) * (boxes[:, 3] - boxes[:, 1] + one)
+        keep = np.ones((boxes.shape[0],), dtype=np.bool_)
+        for g in range(len(starts) - 1):
+            for i in range(starts[g], starts[g + 1]):
+                if not keep[i]:
+                    continue
+                for j in range(i + 1, starts[g + 1]):
+                    if not keep[j]:
+                        continue
+                    w = max(zero, min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0]) + one)
+                    h = max(zero, min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1]) + one)
+                    inter = w * h
+                    if inter / (areas[i] + areas[j] - inter) >= iou_th:
+                        keep[j] = False
+        return keep
+
+    register_nms_backend('numba')(_numba_batched_nms)
+
+
+@register_nms_backend('torch')
+def _torch_batched_nms(boxes, starts, iou_th):
+    from huicv.deps.mini_maskrcnn_benchmark.mini_maskrcnn_benchmark.layers import nms as _box_nms
+    import torch
+    keep = np.zeros((len(boxes),), dtype=bool)
+    # boxes are sorted already, decreasing scores keep the order of boxes with same score
+    scores = torch.arange(len(boxes), 0, -1, dtype=torch.float32)
+    boxes = torch.from_numpy(boxes)
+    for start, end in zip(starts[:-1], starts[1:]):
+        keep[start + _box_nms(boxes[start:end], scores[start:end], float(iou_th)).numpy()] = True
+    return keep
+
+
+def _group_order(scores, idxs):
+    """
+        sort by group and then by score (high first, stable), so each group is a contiguous slice
+        return: order, starts of groups in order (with len(order) at the end)
+    """
+    order = np.lexsort((-scores, idxs))
+    sorted_idxs = idxs[order]
+    starts = np.concatenate([[0], np.nonzero(sorted_idxs[1:] != sorted_idxs[:-1])[0] + 1, [len(order)]])
+    return order, starts.astype(np.int64)
+
+
+def batched_nms(boxes, scores, idxs, iou_th, backend='auto'):
+    """
+        nms of many groups in one call, boxes of different groups never suppress each other.
+        boxes: (N, 4) xyxy, computed in float32 as nms of maskrcnn_benchmark
+        scores: (N,)
+        idxs: (N,) group id of each box, e.g. category id, or image index * num_cats + category index
+        backend: 'auto' or a name in NMS_BACKENDS
+        return: indices of kept boxes, in ascending order (same as nms of maskrcnn_benchmark)
+    """
+    nms_func = get_nms_backend(backend)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape((-1, 4))
+    scores = np.asarray(scores, dtype=np.float32).reshape((-1,))
+    idxs = np.asarray(idxs).reshape((-1,))
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    order, starts = _group_order(scores, idxs)
+    keep = nms_func(np.ascontiguousarray(boxes[order]), starts, iou_th)
+    return np.sort(order[keep])
+
+
+def nms(boxes, scores, iou_th, backend='auto'):
+    """
+        nms of all boxes as one group, return indices of kept boxes in ascending order.
+    """
+    return batched_nms(boxes, scores, np.zeros((len(boxes),), dtype=np.int64), iou_th, backend)
+
+
+def _x_neighbors_finder(boxes):
+    """
+        boxes overlapped with boxes[i] must have x1 in (x1_i - max_w - 1, x2_i + 1), find them in boxes sorted by x1,
+        so soft nms only compute ious with near boxes instead of all remained boxes.
+        return: func(i) => indices of boxes may overlap with boxes[i] (include i)
+    """
+    x_order = np.argsort(boxes[:, 0], kind='mergesort')
+    sorted_x1 = boxes[x_order, 0]
+    max_w = max((boxes[:, 2] - boxes[:, 0]).max(), 0) if len(boxes) > 0 else 0
+
+    def find(i):
+        lo = np.searchsorted(sorted_x1, boxes[i, 0] - max_w - 1, 'left')
+        hi = np.searchsorted(sorted_x1, boxes[i, 2] + 1, 'left')
+        return x_order[lo:hi]
+    return find
+
+
+def _soft_nms_of_sorted(boxes, scores, iou_th, method, sigma, score_th):
+    """
+        soft-nms of boxes sorted by score, the box of max score is kept in each step and the scores of all remained
+        boxes overlapped with it are decayed at once (decay of boxes not overlapped is 1).
+        return: indices of kept boxes in sorted boxes, and their decayed scores
+    """
+    areas = _box_areas(boxes)
+    find_neighbors = _x_neighbors_finder(boxes)
+    scores = scores.copy()
+    # scores of removed and kept boxes are set to -inf
+    remained_scores = np.where(scores >= score_th, scores, -np.inf)
+    keep, keep_scores = [], []
+    while len(keep) < len(boxes):
+        i = np.argmax(remained_scores)
+        if remained_scores[i] == -np.inf:
+            break
+        keep.append(i)
+        keep_scores.append(scores[i])
+        remained_scores[i] = -np.inf
+        neighbors = find_neighbors(i)
+        neighbors = neighbors[remained_scores[neighbors] > -np.inf]
+        ious = _ious_of_one(boxes, areas, i, neighbors)
+        if method == 'linear':
+            scores[neighbors] *= np.where(ious >= iou_th, 1 - ious, 1)
+        else:  # gaussian
+            scores[neighbors] *= np.exp(-(ious * ious) / sigma)
+        remained_scores[neighbors] = np.where(scores[neighbors] >= score_th, scores[neighbors], -np.inf)
+    return np.array(keep, dtype=np.int64), np.array(keep_scores, dtype=np.float64)
+
+
+def batched_soft_nms(boxes, scores, idxs, iou_th=0.3, method='linear', sigma=0.5, score_th=1e-3):
+    """
+        Soft-NMS (Bodla et al. 2017) of many groups, boxes of different groups never decay each other.
+        method: 'linear' => score * (1 - iou) while iou >= iou_th, 'gaussian' => score * exp(-iou^2 / sigma)
+        score_th: boxes whose score (after decayed) < score_th are removed
+        return: indices of kept boxes in ascending order, and their decayed scores
+    """
+    assert method in ['linear', 'gaussian'], "method must be 'linear' or 'gaussian', but got {}".format(method)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    scores = np.asarray(scores, dtype=np.float64).reshape((-1,))
+    idxs = np.asarray(idxs).reshape((-1,))
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.float64)
+    order, starts = _group_order(scores, idxs)
+    keep, keep_scores = [], []
+    for start, end in zip(starts[:-1], starts[1:]):
+        group = order[start:end]
+        group_keep, group_scores = _soft_nms_of_sorted(boxes[group], scores[group], iou_th, method, sigma, score_th)
+        keep.append(group[group_keep])
+        keep_scores.append(group_scores)
+    keep, keep_scores = np.concatenate(keep), np.concatenate(keep_scores)
+    inds = np.argsort(keep)
+    return keep[inds], keep_scores[inds]
+
+
+def _wbf_ious(fused, box):
+    """
+        iou between box and fused boxes of weighted boxes fusion, area without +1 as the reference implementation.
+    """
+    w = np.maximum(np.minimum(fused[:, 2], box[2]) - np.maximum(fused[:, 0], box[0]), 0)
+    h = np.maximum(np.minimum(fused[:, 3], box[3]) - np.maximum(fused[:, 1], box[1]), 0)
+    inter = w * h
+    unions = (fused[:, 2] - fused[:, 0]) * (fused[:, 3] - fused[:, 1]) + (box[2] - box[0]) * (box[3] - box[1]) - inter
+    return np.where(unions > 0, inter / np.where(unions > 0, unions, 1), 0)
+
+
+@register_wbf_backend('numpy')
+def _numpy_wbf_clusters(boxes, scores, starts, iou_th):
+    """
+        each box (sorted by group and then by score, high first) joins the cluster whose current fused box has the
+        max iou with it (must > iou_th), or starts a new cluster, the fused box is updated after each join.
+        return: cluster id of each box, ids are increasing in the order clusters are created
+    """
+    n = len(boxes)
+    clusters = np.empty((n,), dtype=np.int64)
+    fused, box_sums = np.empty((n, 4)), np.empty((n, 4))
+    score_sums = np.empty((n,))
+    num_clusters = 0
+    for start, end in zip(starts[:-1], starts[1:]):
+        first = num_clusters
+        for j in range(start, end):
+            c = -1
+            if num_clusters > first:
+                ious = _wbf_ious(fused[first:num_clusters], boxes[j])
+                best = np.argmax(ious)
+                if ious[best] > iou_th:
+                    c = first + best
+            if c < 0:
+                c, num_clusters = num_clusters, num_clusters + 1
+                box_sums[c], score_sums[c] = 0, 0
+            box_sums[c] += scores[j] * boxes[j]
+            score_sums[c] += scores[j]
+            fused[c] = box_sums[c] / score_sums[c] if score_sums[c] > 0 else boxes[j]
+            clusters[j] = c
+    return clusters
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _numba_wbf_clusters(boxes, scores, starts, iou_th):
+        n = boxes.shape[0]
+        clusters = np.empty((n,), dtype=np.int64)
+        fused, box_sums = np.empty((n, 4)), np.empty((n, 4))
+        score_sums = np.empty((n,))
+        num_clusters = 0
+        for g in range(len(starts) - 1):
+            first = num_clusters
+            for j in range(starts[g], starts[g + 1]):
+                c, best_iou = -1, iou_th
+                area_j = (boxes[j, 2] - boxes[j, 0]) * (boxes[j, 3] - boxes[j, 1])
+                for k in range(first, num_clusters):
+                    w = max(min(fused[k, 2], boxes[j, 2]) - max(fused[k, 0], boxes[j, 0]), 0.)
+                    h = max(min(fused[k, 3], boxes[j, 3]) - max(fused[k, 1], boxes[j, 1]), 0.)
+                    inter = w * h
+                    union = (fused[k, 2] - fused[k, 0]) * (fused[k, 3] - fused[k, 1]) + area_j - inter
+                    iou = inter / union if union > 0 else 0.
+                    if iou > best_iou:
+                        c, best_iou = k, iou
+                if c < 0:
+                    c, num_clusters = num_clusters, num_clusters + 1
+                    box_sums[c, :] = 0
+                    score_sums[c] = 0
+                box_sums[c, :] += scores[j] * boxes[j, :]
+                score_sums[c] += scores[j]
+                if score_sums[c] > 0:
+                    fused[c, :] = box_sums[c, :] / score_sums[c]
+                else:
+                    fused[c, :] = boxes[j, :]
+                clusters[j] = c
+        return clusters
+
+    register_wbf_backend('numba')(_numba_wbf_clusters)
+
+
+def batched_wbf(boxes, scores, idxs, iou_th=0.55, num_models=1, backend='auto'):
+    """
+        weighted boxes fusion (Solovyev et al. 2019, conf_type 'avg' of ensemble_boxes) of many groups, boxes of
+        different groups are never fused. boxes are visited by score (high first), each box joins the cluster whose
+        fused box has the max iou with it (iou > iou_th) or starts a new cluster, and the fused box is updated.
+        the fused box is the score weighted average of boxes in the cluster, the fused score is the mean score of
+        the cluster rescaled by min(num_models, cluster size) / num_models.
+        num_models: number of models (or views) whose boxes are fused, 1 for the boxes of one detector.
+        backend: 'auto' or a name in WBF_BACKENDS
+        return: indices of the max score box of each cluster in ascending order, fused boxes and fused scores
+    """
+    cluster_func = get_wbf_backend(backend)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    scores = np.asarray(scores, dtype=np.float64).reshape((-1,))
+    idxs = np.asarray(idxs).reshape((-1,))
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0, 4), dtype=np.float64), np.zeros((0,), dtype=np.float64)
+    order, starts = _group_order(scores, idxs)
+    sorted_boxes, sorted_scores = np.ascontiguousarray(boxes[order]), np.ascontiguousarray(scores[order])
+    clusters = cluster_func(sorted_boxes, sorted_scores, starts, float(iou_th))
+
+    # clusters are created in sorted order, so the first box of a cluster is its max score box
+    _, seeds = np.unique(clusters, return_index=True)
+    num_clusters = len(seeds)
+    counts = np.bincount(clusters, minlength=num_clusters)
+    score_sums = np.bincount(clusters, weights=sorted_scores, minlength=num_clusters)
+    box_sums = np.stack([np.bincount(clusters, weights=sorted_scores * sorted_boxes[:, k], minlength=num_clusters)
+                         for k in range(4)], axis=1)
+    fused_boxes = np.where(score_sums[:, None] > 0, box_sums / np.maximum(score_sums, 1e-12)[:, None],
+                           sorted_boxes[seeds])
+    fused_scores = score_sums / counts * np.minimum(num_models, counts) / num_models
+
+    keep = order[seeds]
+    inds = np.argsort(keep)
+    return keep[inds], fused_boxes[inds], fused_scores[inds]
+
+
+def benchmark_nms_backends(sizes=(1000, 10000, 100000), group_size=1000, iou_th=0.5, repeat=3, backends=None,
+                           seed=0):
+    """
+        time batched_nms of each backend on random boxes of sizes, each group has group_size boxes (like the boxes of
+        one category in one merged image), also check all backends keep same boxes.
+        return: OrderedDict of {(backend, size): seconds}
+    """
+    backends = [name for name in NMS_BACKENDS if name != 'torch'] if backends is None else backends
+    rng = np.random.RandomState(seed)
+    times = OrderedDict()
+    for size in sizes:
+        xy = rng.uniform(0, 640, (size, 2))
+        boxes = np.concatenate([xy, xy + rng.uniform(4, 64, (size, 2))], axis=1)
+        scores = rng.rand(size)
+        idxs = np.arange(size) // group_size
+        keeps = []
+        for backend in backends:
+            batched_nms(boxes[:10], scores[:10], idxs[:10], iou_th, backend)  # warm up, e.g. jit of numba
+            tic = time.time()
+            for _ in range(repeat):
+                keep = batched_nms(boxes, scores, idxs, iou_th, backend)
+            times[backend, size] = (time.time() - tic) / repeat
+            keeps.append(keep)
+            print('[benchmark_nms_backends] {:>8s} {:>7d} boxes: {:.4f}s, keep {}'.format(
+                backend, size, times[backend, size], len(keep)))
+        assert all(np.array_equal(keeps[0], keep) for keep in keeps), "backends keep different boxes"
+    return times
+
+
+if __name__ == '__main__':
+    benchmark_nms_backends()
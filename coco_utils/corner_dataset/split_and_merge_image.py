@@ -5,6 +5,7 @@ import os
 import cv2
 from PIL import Image
 from tqdm import tqdm
+from huicv.coco_utils.corner_dataset.nms import batched_nms, batched_soft_nms, batched_wbf, nms as _box_nms, WBF_BACKENDS
 
 
 class SplitImage(object):
@@ -154,15 +155,43 @@ class SplitImage(object):
 
 
 class MergeResult(object):
-    def __init__(self, use_nms=True, nms_th=0.5):
+    MERGE_METHODS = ['nms', 'soft_nms_linear', 'soft_nms_gaussian', 'wbf']
+
+    def __init__(self, use_nms=True, nms_th=0.5, nms_backend='auto', merge_method='nms', soft_nms_sigma=0.5,
+                 score_th=1e-3):
+        """
+            nms_backend: 'auto' or a backend name of huicv.coco_utils.corner_dataset.nms.NMS_BACKENDS,
+                e.g. 'numpy', 'numba', 'torch' (needs the _C extension of mini_maskrcnn_benchmark)
+            merge_method: how overlapped boxes are merged while use_nms, nms_th is the iou th of all methods.
+                'nms': hard nms
+                'soft_nms_linear'/'soft_nms_gaussian': Soft-NMS, scores of overlapped boxes are decayed instead of
+                    removed, soft_nms_sigma is the sigma of gaussian, boxes whose score < score_th are removed.
+                'wbf': weighted boxes fusion, overlapped boxes are fused to one box, see nms.batched_wbf,
+                    clustered by nms_backend if it is one of nms.WBF_BACKENDS, otherwise 'auto'.
+        """
+        assert merge_method in self.MERGE_METHODS, "merge_method must be one of {}, but got {}".format(
+            self.MERGE_METHODS, merge_method)
         self.use_nms = use_nms
         self.nms_th = nms_th
+        self.nms_backend = nms_backend
+        self.merge_method = merge_method
+        self.soft_nms_sigma = soft_nms_sigma
+        self.score_th = score_th
 
-    def merge_result(self, corners, results, scores=None):
+    def merge_result(self, corners, results, scores=None, return_scores=False):
+        """
+            return_scores: also return scores of merged results, which are changed by soft nms and wbf
+        """
         merge_result = self.translate_bboxes(corners, results)
         no_empty_result = sum([len(result) > 0 for result in results])
         if no_empty_result > 1 and self.use_nms:  # only when no_empty sub result > 1, need nms to merge in overlap area
-            merge_result, keep = self.nms(merge_result, scores)
+            if self.merge_method == 'nms':
+                merge_result, keep = self.nms(merge_result, scores)
+                scores = None if scores is None else np.asarray(scores)[keep]
+            else:
+                merge_result, scores = self.merge_rows(merge_result, scores)
+        if return_scores:
+            return merge_result, scores
         return merge_result
 
     def merge_maskrcnn_benchmark_result(self, corners, results, im_scales=None, image_size=None):
@@ -191,8 +220,12 @@ class MergeResult(object):
             det_results = results
         det_results = self.translate_bboxes(corners, det_results)
         if len(det_results) == 0: return []
-        _, keep = self.nms(det_results[:, :4], det_results[:, 5])
-        det_results = det_results[keep]
+        if self.merge_method == 'nms':
+            _, keep = self.nms(det_results[:, :4], det_results[:, 5])
+            det_results = det_results[keep]
+        else:
+            det_results, scores = self.merge_rows(det_results, det_results[:, 5])
+            det_results[:, 5] = scores
 
         if input_BoxList:
             merge_result = BoxList(torch.Tensor(det_results[:, :4]), image_size, 'xyxy')
@@ -220,16 +253,48 @@ class MergeResult(object):
         return merge_result
 
     def nms(self, merge_result, scores):
-        from huicv.deps.mini_maskrcnn_benchmark.mini_maskrcnn_benchmark.layers import nms as _box_nms
-        import torch
         if scores is None:
-            scores = torch.ones(size=(len(merge_result),))
-        if not isinstance(scores, torch.Tensor):
-            scores = torch.Tensor(scores)
-        merge_result = torch.Tensor(merge_result)
-        keep = _box_nms(merge_result, scores, self.nms_th)
-        merge_result = merge_result[keep].detach().cpu().numpy()
-        return merge_result, keep.detach().cpu().numpy()
+            scores = np.ones((len(merge_result),))
+        merge_result = np.asarray(merge_result, dtype=np.float32)
+        if len(merge_result) == 0:
+            return merge_result, np.zeros((0,), dtype=np.int64)
+        keep = _box_nms(merge_result[:, :4], scores, self.nms_th, self.nms_backend)
+        return merge_result[keep], keep
+
+    def merge_boxes(self, boxes, scores, idxs=None):
+        """
+            merge overlapped boxes by merge_method, boxes of different idxs (e.g. image or category) are not merged.
+            boxes: (N, 4) xyxy, scores: (N,), idxs: (N,) or None for one group
+            return: indices of kept boxes in ascending order, boxes and scores of them (fused or decayed)
+        """
+        boxes, scores = np.asarray(boxes).reshape((-1, 4)), np.asarray(scores, dtype=np.float64).reshape((-1,))
+        idxs = np.zeros((len(boxes),), dtype=np.int64) if idxs is None else idxs
+        if self.merge_method == 'nms':
+            keep = batched_nms(boxes, scores, idxs, self.nms_th, self.nms_backend)
+            # kept boxes are float32 as the torch nms returned
+            return keep, boxes[keep].astype(np.float32), scores[keep]
+        elif self.merge_method == 'wbf':
+            backend = self.nms_backend if self.nms_backend in WBF_BACKENDS else 'auto'
+            return batched_wbf(boxes, scores, idxs, self.nms_th, backend=backend)
+        else:
+            method = self.merge_method[len('soft_nms_'):]
+            keep, scores = batched_soft_nms(boxes, scores, idxs, self.nms_th, method, self.soft_nms_sigma,
+                                            self.score_th)
+            return keep, boxes[keep], scores
+
+    def merge_rows(self, rows, scores=None, idxs=None):
+        """
+            merge rows (N, >=4) whose first 4 columns are xyxy boxes by merge_boxes.
+            return: merged rows (boxes are replaced by merged boxes) and their scores
+        """
+        rows = np.asarray(rows)
+        if len(rows) == 0:
+            return rows, scores
+        scores = np.ones((len(rows),)) if scores is None else scores
+        keep, boxes, scores = self.merge_boxes(rows[:, :4], scores, idxs)
+        rows = rows[keep]
+        rows[:, :4] = boxes
+        return rows, scores
 
 
 def xywh2xyxy(boxes):
@@ -417,6 +482,14 @@ class COCOSplitImage(SplitImage):
 
 
 class COCOMergeResult(MergeResult):
+    def __init__(self, use_nms=True, nms_th=0.5, class_aware=False, *args, **kwargs):
+        """
+            class_aware: if True, only boxes of same category suppress each other in nms, otherwise (default)
+                all boxes of an image.
+            args, kwargs: nms_backend, merge_method, ... of MergeResult
+        """
+        super(COCOMergeResult, self).__init__(use_nms, nms_th, *args, **kwargs)
+        self.class_aware = class_aware
 
     def __turn_det_result(self, bbox, image_id, old_det_result):
         det_result = deepcopy(old_det_result)
@@ -453,8 +526,9 @@ class COCOMergeResult(MergeResult):
         if os.path.isdir(dst_path):
             f_dir, f_name = os.path.split(src_path)
             f, ext = os.path.splitext(f_name)
+            method = 'nms' if self.merge_method == 'nms' or not self.use_nms else self.merge_method
             save_pth = os.path.join(dst_path,
-                                    '{}_merge_nms{}{}'.format(f, self.nms_th if self.use_nms else 'None', ext))
+                                    '{}_merge_{}{}{}'.format(f, method, self.nms_th if self.use_nms else 'None', ext))
         else:
             save_pth = dst_path
         json.dump(json_data, open(save_pth, 'w'), separators=(',', ':'))
@@ -486,7 +560,7 @@ class COCOMergeResult(MergeResult):
                 merge_image_id_to_corners[merge_image_id].append(image_id_to_image_info[image_id]['corner'])
 
         # merge all det result
-        all_merge_det_results = []
+        merge_image_boxes, merge_image_det_results = [], []
         for merge_image_id in tqdm(merge_image_id_to_det_results):
             corners = merge_image_id_to_corners[merge_image_id]
             det_results_list = merge_image_id_to_det_results[merge_image_id]
@@ -498,26 +572,55 @@ class COCOMergeResult(MergeResult):
                 det_bboxes.append(np.array([xywh2xyxy(np.array(det_result['bbox']))
                                             for det_result in det_results]))
             merge_boxes = self.translate_bboxes(corners, det_bboxes)
-
-            # nms
-            if self.use_nms:
-                scores = [det_result['score'] for det_result in old_det_results]
-                merge_boxes, keeps = self.nms(merge_boxes, scores)
-                old_det_results = [old_det_results[keep] for keep in keeps]
-
-            # turn bbox to det_result
-            merge_results = []
-            for bbox, old_det_result in zip(merge_boxes, old_det_results):
+            merge_image_boxes.append(merge_boxes.reshape((-1, 4)))
+            merge_image_det_results.append(old_det_results)
+
+        # nms (or other merge_method) of all merged images in one batch
+        merge_image_scores = [None] * len(merge_image_boxes)
+        if self.use_nms:
+            merged = self.batched_merge(merge_image_boxes, merge_image_det_results)
+            merge_image_det_results = [[det_results[i] for i in keep]
+                                       for det_results, (keep, _, _) in zip(merge_image_det_results, merged)]
+            merge_image_boxes = [boxes for _, boxes, _ in merged]
+            if self.merge_method != 'nms':  # scores are decayed by soft nms or fused by wbf
+                merge_image_scores = [scores for _, _, scores in merged]
+
+        # turn bbox to det_result
+        all_merge_det_results = []
+        for merge_image_id, merge_boxes, old_det_results, scores in zip(
+                merge_image_id_to_det_results, merge_image_boxes, merge_image_det_results, merge_image_scores):
+            for i, (bbox, old_det_result) in enumerate(zip(merge_boxes, old_det_results)):
                 det_result = self.__turn_det_result(bbox, merge_image_id, old_det_result)
-                merge_results.append(det_result)
-
-            all_merge_det_results.extend(merge_results)
+                if scores is not None:
+                    det_result['score'] = float(scores[i])
+                all_merge_det_results.append(det_result)
 
         save_pth = None
         if dst_det_file_path is not None:
             save_pth = self.__save_file(all_merge_det_results, src_det_file_path, dst_det_file_path)
         return all_merge_det_results, save_pth
 
+    def batched_merge(self, merge_image_boxes, merge_image_det_results):
+        """
+            merge boxes of all merged images by one merge_boxes call instead of a torch nms for each image, boxes are
+            grouped by image (and category if class_aware), so only boxes of the same group are merged.
+            return: [(indices of kept boxes in ascending order, merged boxes, scores)] of each merged image
+        """
+        boxes = np.concatenate(merge_image_boxes) if len(merge_image_boxes) > 0 else np.zeros((0, 4))
+        det_results = [det_result for det_results in merge_image_det_results for det_result in det_results]
+        scores = [det_result['score'] for det_result in det_results]
+        num_boxes = [len(image_boxes) for image_boxes in merge_image_boxes]
+        idxs = np.repeat(np.arange(len(num_boxes)), num_boxes)
+        if self.class_aware:
+            cat_ids, cat_idxs = np.unique([det_result['category_id'] for det_result in det_results],
+                                          return_inverse=True)
+            idxs = idxs * len(cat_ids) + cat_idxs.reshape((-1,))
+        keep, boxes, scores = self.merge_boxes(boxes, scores, idxs)
+        starts = np.cumsum([0] + num_boxes)
+        bounds = np.searchsorted(keep, starts)
+        return [(keep[bounds[i]: bounds[i + 1]] - starts[i], boxes[bounds[i]: bounds[i + 1]],
+                 scores[bounds[i]: bounds[i + 1]]) for i in range(len(num_boxes))]
+
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
@@ -528,6 +631,9 @@ if __name__ == '__main__':
     parser.add_argument("--save_merge_det", default='')
     parser.add_argument("--origin_gt", default="")
     parser.add_argument("--merge_nms_th", default=0.5, type=float)
+    parser.add_argument("--class_aware_nms", action='store_true', help="only boxes of same category suppress each other")
+    parser.add_argument("--nms_backend", default='auto', help="'auto', 'numpy', 'numba' or 'torch'")
+    parser.add_argument("--merge_method", default='nms', help="'nms', 'soft_nms_linear', 'soft_nms_gaussian' or 'wbf'")
     args = parser.parse_args()
 
     if args.type == 'merge':
@@ -536,7 +642,9 @@ if __name__ == '__main__':
         if args.merge_nms_th <= 0 or args.merge_nms_th >= 1.0:
             merger = COCOMergeResult(use_nms=False, nms_th=1.0)
         else:
-            merger = COCOMergeResult(use_nms=True, nms_th=args.merge_nms_th)
+            merger = COCOMergeResult(use_nms=True, nms_th=args.merge_nms_th,
+                                     class_aware=args.class_aware_nms, nms_backend=args.nms_backend,
+                                     merge_method=args.merge_method)
         print("merge args:", merger.__dict__)
         merger(args.corner_gt, args.corner_det, args.save_merge_det,
                None if len(args.origin_gt) == 0 else args.origin_gt)
@@ -5,6 +5,7 @@ import os
 TOOL_DIR = os.path.abspath(__file__ + '/..') + '/evaluation/eval_script/'
 sys.path.insert(0, TOOL_DIR)
 import os
+from collections import OrderedDict
 from coco import COCO
 from eval_MR_multisetup import COCOeval, Params
 
@@ -31,25 +32,56 @@ def turn_bbox(src_file, dst_file):
     json.dump(json_data, open(dst_file, 'w'))
 
 
-def cityperson_eval(src_pth, annFile, CUT_WH=None,
-                    ignore_uncertain=False, use_iod_for_ignore=False, catIds=[],
-                    use_citypersons_standard=True, tiny_scale=1.0, iou_ths=None, setup_labels=None):
+def cityperson_eval(*args, **kwargs):
+    """
+        args: see cityperson_eval_setups
+        return: OrderedDict of MR(%) of all evaluated setups, e.g. {'MR50_tiny1': .., 'MR75_tiny1': .., ...}
+    """
+    mr_of_setups = cityperson_eval_setups(*args, **kwargs)
+    return OrderedDict(('MR{:d}_{}'.format(int(round(iouThr * 100)), setup), mr)
+                       for setup, mrs in mr_of_setups.items() for iouThr, mr in mrs.items())
+
+
+def cityperson_eval_setups(src_pth, annFile, CUT_WH=None,
+                           ignore_uncertain=False, use_iod_for_ignore=False, catIds=[],
+                           use_citypersons_standard=True, tiny_scale=1.0, iou_ths=None, setup_labels=None,
+                           iou_cache_dir=None, cocoGt=None, cocoDt=None, iou_cache=None, num_process=1, res_file=None):
+    """
+        cocoGt, cocoDt: loaded COCO objects of annFile and src_pth, use them instead of loading the files again.
+            the 'ignore' flag of gt anns in cocoGt is set for each setup while evaluating, so do not evaluate
+            the same cocoGt in multi threads at the same time.
+        iou_cache: IoUCache shared with other evaluations of the same files, iou_cache_dir is not used if given.
+        num_process: evaluate the setups on image shards in num_process processes, -1 use all cpu.
+        res_file: path to write the summary lines of all setups, not written if None.
+        return: OrderedDict of {setup label: OrderedDict of {iou th: MR(%)}}, e.g. mrs['tiny1'][0.5]
+    """
     if os.path.isdir(src_pth):
         resFile = src_pth + '/' + 'bbox.json'
     else:
         resFile = src_pth
-    Params.CITYPERSON_STANDARD = use_citypersons_standard
     if use_citypersons_standard:
         kwargs = {}
         if CUT_WH is None: CUT_WH = (1, 1)
     else:
         kwargs = {'filter_type': 'size'}
         if CUT_WH is None: CUT_WH = (1, 1)
-        Params.TINY_SCALE = tiny_scale
-    Params.IOU_THS = iou_ths
+    # setup is passed to Params of each evaluation instead of set to Params class attributes
+    params_kwargs = dict(cut_wh=CUT_WH, citypersons_standard=use_citypersons_standard,
+                         tiny_scale=tiny_scale, iou_ths=iou_ths)
 
     kwargs.update({'use_iod_for_ignore': use_iod_for_ignore, 'ignore_uncertain': ignore_uncertain})
     kwargs['given_catIds'] = len(catIds) > 0
+    if iou_cache is not None:
+        kwargs['iou_cache'] = iou_cache
+    elif iou_cache_dir is not None:  # ious are computed once and reused by all setups and later runs
+        from huicv.evaluation.iou_cache import IoUCache
+        kwargs['iou_cache'] = IoUCache.from_files(iou_cache_dir, annFile, resFile)
+    if cocoGt is not None and cocoDt is not None:
+        for ann in cocoDt.dataset['annotations']:
+            ann['height'] = ann['bbox'][3]  # set by loadRes of eval_script/coco.py
+    else:
+        cocoGt = COCO(annFile)
+        cocoDt = cocoGt.loadRes(resFile)
 
     annType = 'bbox'      # specify type here
     print('Running demo for *%s* results.' % annType)
@@ -59,21 +91,19 @@ def cityperson_eval(src_pth, annFile, CUT_WH=None,
     print('use_citypersons_standard:', use_citypersons_standard)
     print('tiny_scale:', tiny_scale)
     print(kwargs)
-    res_file = open("results.txt", "w")
-    Params.CUT_WH = CUT_WH
-    setupLbl = Params().SetupLbl
-    for id_setup in range(len(setupLbl)):
-        if (setup_labels is None) or (setupLbl[id_setup] in setup_labels):
-            cocoGt = COCO(annFile)
-            cocoDt = cocoGt.loadRes(resFile)
-            imgIds = sorted(cocoGt.getImgIds())
-            cocoEval = COCOeval(cocoGt, cocoDt, annType, **kwargs)
-            cocoEval.params.imgIds = imgIds
-            cocoEval.evaluate(id_setup)
-            cocoEval.accumulate()
-            cocoEval.summarize(id_setup,res_file)
-
-    res_file.close()
+    setupLbl = Params(**params_kwargs).SetupLbl
+    id_setups = [id_setup for id_setup in range(len(setupLbl))
+                 if (setup_labels is None) or (setupLbl[id_setup] in setup_labels)]
+    # gts/dts are prepared and ious are computed once for all setups
+    imgIds = sorted(cocoGt.getImgIds())
+    cocoEval = COCOeval(cocoGt, cocoDt, annType, params=Params(annType, **params_kwargs), **kwargs)
+    cocoEval.params.imgIds = imgIds
+    evalImgs_of_setups = cocoEval.evaluate_all_setups(id_setups, num_process=num_process)
+    f = open(res_file, "w") if res_file is not None else None
+    mr_of_setups = cocoEval.summarize_all_setups(evalImgs_of_setups, f)
+    if f is not None:
+        f.close()
+    return mr_of_setups
 
 
 if __name__ == '__main__':
@@ -101,4 +131,4 @@ if __name__ == '__main__':
         '/home/hui/github/cur_code/outputs/cityperson_FPN_baseline1.json',
         '/home/hui/dataset/cityscapes/perdestrian_annotations/citypersons_all_val.json', CUT_WH=(1, 1),
         ignore_uncertain=False, use_iod_for_ignore=False, catIds=[],
-        use_citypersons_standard=True) #, tiny_scale=4.11886287119646)
+        use_citypersons_standard=True, res_file='results.txt') #, tiny_scale=4.11886287119646)
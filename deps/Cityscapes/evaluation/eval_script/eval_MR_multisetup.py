@@ -1,9 +1,10 @@
 import numpy as np
 import datetime
 import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 # from . import mask as maskUtils
 import copy
+import multiprocessing
 import matplotlib.pyplot as plt
 import scipy.io as sio
 
@@ -60,11 +61,13 @@ class COCOeval:
     # Licensed under the Simplified BSD License [see coco/license.txt]
     def __init__(self, cocoGt=None, cocoDt=None, iouType='segm',
                  filter_type='height', use_iod_for_ignore=False,
-                 ignore_uncertain=False, given_catIds=False):  # add by hui
+                 ignore_uncertain=False, given_catIds=False, iou_cache=None, params=None):  # add by hui
         '''
         Initialize CocoEval using coco APIs for gt and dt
         :param cocoGt: coco object with ground truth annotations
         :param cocoDt: coco object with detection results
+        :param iou_cache: huicv.evaluation.iou_cache.IoUCache of (gt file, det file), ious are read from it if cached
+        :param params: Params of this evaluation, default Params(iouType) with the setup of Params class attributes
         :return: None
         '''
         if not iouType:
@@ -76,7 +79,7 @@ class COCOeval:
         self.eval = {}                  # accumulated evaluation results
         self._gts = defaultdict(list)       # gt for evaluation
         self._dts = defaultdict(list)       # dt for evaluation
-        self.params = Params(iouType=iouType)  # parameters
+        self.params = Params(iouType=iouType) if params is None else params  # parameters
         self._paramsEval = {}               # parameters for evaluation
         self.stats = []                     # result summarization
         self.ious = {}                      # ious between all gts and dts
@@ -89,6 +92,7 @@ class COCOeval:
         assert filter_type in ['height', 'size'], "filter type must be 'height' or 'size'"
         self.use_iod_for_ignore = use_iod_for_ignore
         self.ignore_uncertain = ignore_uncertain
+        self.iou_cache = iou_cache
         # ##########################################################################################
 
     def _prepare(self, id_setup):
@@ -104,9 +108,27 @@ class COCOeval:
             gts = self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
             dts = self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
 
-        # set ignore flag
+        self._set_ignore(gts, id_setup)
+
+        self._gts = defaultdict(list)       # gt for evaluation
+        self._dts = defaultdict(list)       # dt for evaluation
+        for gt in gts:
+            self._gts[gt['image_id'], gt['category_id']].append(gt)
+        for dt in dts:
+            self._dts[dt['image_id'], dt['category_id']].append(dt)
+        self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
+        self.eval = {}                  # accumulated evaluation results
+
+    def _set_ignore(self, gts, id_setup):
+        '''
+        add by hui, set ignore flag of gts for setup id_setup, split from _prepare so prepared gts can be
+        evaluated with other setups.
+        '''
         for gt in gts:
-            gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
+            # add by hui, keep the ignore flag of file, so the same cocoGt can be evaluated by other setups
+            if 'ori_ignore' not in gt:
+                gt['ori_ignore'] = gt['ignore'] if 'ignore' in gt else 0
+            gt['ignore'] = gt['ori_ignore']
             # ########################################################### change by hui ###############################
             import math
             if 'vis_ratio' not in gt:
@@ -129,18 +151,11 @@ class COCOeval:
                 gt['ignore'] = 1
             ##########################################################
 
-        self._gts = defaultdict(list)       # gt for evaluation
-        self._dts = defaultdict(list)       # dt for evaluation
-        for gt in gts:
-            self._gts[gt['image_id'], gt['category_id']].append(gt)
-        for dt in dts:
-            self._dts[dt['image_id'], dt['category_id']].append(dt)
-        self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
-        self.eval = {}                  # accumulated evaluation results
-
-    def evaluate(self, id_setup):
+    def evaluate(self, id_setup, reuse_prepared=False):
         '''
         Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        :param reuse_prepared: (add by hui) only reset ignore flags of ._gts prepared by last evaluate for id_setup,
+            instead of loading gts and dts again
         :return: None
         '''
         tic = time.time()
@@ -157,7 +172,23 @@ class COCOeval:
         p.maxDets = sorted(p.maxDets)
         self.params=p
 
-        self._prepare(id_setup)
+        if reuse_prepared:
+            for gts in self._gts.values():
+                self._set_ignore(gts, id_setup)
+        else:
+            self._prepare(id_setup)
+        self.evalImgs = self._evaluate_prepared(id_setup)
+        if self.iou_cache is not None:
+            self.iou_cache.save()
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def _evaluate_prepared(self, id_setup):
+        '''
+        add by hui, compute ious and evalImgs of prepared ._gts/._dts, whose ignore flags are set for id_setup
+        '''
+        p = self.params
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
@@ -171,13 +202,108 @@ class COCOeval:
         maxDet = p.maxDets[-1]
         HtRng = self.params.HtRng[id_setup]
         VisRng = self.params.VisRng[id_setup]
-        self.evalImgs = [evaluateImg(imgId, catId, HtRng, VisRng, maxDet)
+        return [evaluateImg(imgId, catId, HtRng, VisRng, maxDet)
                  for catId in catIds
                  for imgId in p.imgIds
              ]
+
+    # add by hui
+    def evaluate_all_setups(self, id_setups=None, num_process=1, num_image_shards=None):
+        '''
+        evaluate all setups (or the given id_setups) with gts/dts prepared once. setups only differ in the ignore
+        flags of gts, so iou and iod of each (img, cat) are computed once (in the iou cache, an in-memory one if
+        not given), and each setup only chooses ious by its ignore flags and runs the matching.
+        :param num_process: 0/1 evaluate in current process, -1 use all cpu. images are split into shards, and
+            all setups of a shard are evaluated in one worker process, so ious are still computed once.
+        :param num_image_shards: number of image shards while num_process > 1, default 4 * num_process.
+        :return: OrderedDict of {id_setup: evalImgs}, set self.evalImgs to one of them before accumulate() and
+            summarize(id_setup) of that setup, or use summarize_all_setups.
+        '''
+        if id_setups is None:
+            id_setups = list(range(len(self.params.SetupLbl)))
+        num_process = multiprocessing.cpu_count() if num_process < 0 else num_process
+        if num_process > 1:
+            return self.evaluate_setups_in_shards(id_setups, num_process, num_image_shards)
+        from huicv.evaluation.iou_cache import IoUCache
+        iou_cache = self.iou_cache
+        if iou_cache is None:
+            self.iou_cache = IoUCache()
+        evalImgs_of_setups = OrderedDict()
+        try:
+            for i, id_setup in enumerate(id_setups):
+                self.evaluate(id_setup, reuse_prepared=i > 0)
+                evalImgs_of_setups[id_setup] = self.evalImgs
+        finally:
+            self.iou_cache = iou_cache
+        return evalImgs_of_setups
+
+    def evaluate_setups_in_shards(self, id_setups, num_process, num_image_shards=None):
+        '''
+        split images into contiguous shards and evaluate all id_setups of each shard in worker processes, only anns
+        of the shard are sent to the worker. evalImgs of each setup are merged back in the order of catId -> imgId,
+        same as evaluate().
+        '''
+        from huicv.evaluation.multi_process import multiprocess_map, split_shards
+        tic = time.time()
+        print('Running per image evaluation of {} setups in {} processes...'.format(len(id_setups), num_process))
+        p = self.params
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self._prepare(id_setups[0])
+        catIds = p.catIds if p.useCats else [-1]
+
+        shards = split_shards(p.imgIds, num_image_shards, num_process)
+        args_list = []
+        for shard in shards:
+            keys = [(imgId, cId) for imgId in shard for cId in p.catIds]
+            gts = {key: self._gts[key] for key in keys if key in self._gts}
+            dts = {key: self._dts[key] for key in keys if key in self._dts}
+            args_list.append((id_setups, shard, gts, dts))
+
+        # worker only need params and flags, do not pickle COCO objects and anns of all images to each task
+        worker = copy.copy(self)
+        worker.cocoGt, worker.cocoDt = None, None
+        worker.params = copy.deepcopy(self.params)
+        worker._gts, worker._dts = defaultdict(list), defaultdict(list)
+        worker.ious, worker.evalImgs, worker.eval = {}, [], {}
+        shards_res = multiprocess_map(worker.evaluate_setups_of_shard, args_list, num_process=num_process)
+
+        evalImgs_of_setups = OrderedDict((id_setup, []) for id_setup in id_setups)
+        for _, new_cache_entries in shards_res:
+            if self.iou_cache is not None:
+                self.iou_cache.update(new_cache_entries)
+        for id_setup in id_setups:
+            for ci in range(len(catIds)):
+                for shard, (shard_evalImgs, _) in zip(shards, shards_res):
+                    evalImgs_of_setups[id_setup].extend(shard_evalImgs[id_setup][ci * len(shard): (ci + 1) * len(shard)])
+        if self.iou_cache is not None:
+            self.iou_cache.save()
+        self.ious = {}  # ious of each setup are only kept in worker
+        self.evalImgs = evalImgs_of_setups[id_setups[-1]]
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format(toc-tic))
+        return evalImgs_of_setups
+
+    def evaluate_setups_of_shard(self, id_setups, imgIds, gts, dts):
+        '''
+        evaluate id_setups on images of one shard in worker process.
+        gts/dts: {(imgId, catId): anns} of the shard, used instead of self._gts/self._dts.
+        :return: ({id_setup: evalImgs of the shard}, new entries of iou cache)
+        '''
+        from huicv.evaluation.iou_cache import IoUCache
+        self.params.imgIds = imgIds
+        self._gts, self._dts = defaultdict(list, gts), defaultdict(list, dts)
+        if self.iou_cache is None:
+            self.iou_cache = IoUCache()
+        evalImgs_of_setups = OrderedDict()
+        for id_setup in id_setups:
+            for gts_of_img in self._gts.values():
+                self._set_ignore(gts_of_img, id_setup)
+            evalImgs_of_setups[id_setup] = self._evaluate_prepared(id_setup)
+        return evalImgs_of_setups, self.iou_cache.pop_new_entries()
 
     def computeIoU(self, imgId, catId):
         p = self.params
@@ -191,6 +317,15 @@ class COCOeval:
             return []
         inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
         dt = [dt[i] for i in inds]
+        # add by hui, ious of ignore gts (iou = inter / det_area) and other gts only depend on boxes,
+        # so both of them are cached for all dets, and chosen by the ignore flag of current setup
+        if self.iou_cache is not None and p.iouType == 'bbox' and len(gt) > 0 and len(dt) > 0:
+            # same cache name as COCOExpandEval, so the ious are shared with the AP evaluation of the same files
+            iscrowd = np.array([bool(o['ignore']) for o in gt])
+            cache_name = 'bbox' if p.useCats else 'bbox_cats{}'.format(','.join(map(str, p.catIds)))
+            ious, iods = self.iou_cache.bbox_iou_and_iod(imgId, catId, [d['bbox'] for d in dt],
+                                                         [g['bbox'] for g in gt], cache_name)
+            return np.where(iscrowd[None, :], iods, ious)[:p.maxDets[-1]]
         if len(dt) > p.maxDets[-1]:
             dt=dt[0:p.maxDets[-1]]
 
@@ -211,73 +346,30 @@ class COCOeval:
         return ious
 
     def iou(self, dts, gts, pyiscrowd):
-        dts = np.asarray(dts)
-        gts = np.asarray(gts)
-        pyiscrowd = np.asarray(pyiscrowd)
-        ious = np.zeros((len(dts), len(gts)))
-        for j, gt in enumerate(gts):
-            gx1 = gt[0]
-            gy1 = gt[1]
-            gx2 = gt[0] + gt[2]
-            gy2 = gt[1] + gt[3]
-            garea = gt[2] * gt[3]
-            for i, dt in enumerate(dts):
-                dx1 = dt[0]
-                dy1 = dt[1]
-                dx2 = dt[0] + dt[2]
-                dy2 = dt[1] + dt[3]
-                darea = dt[2] * dt[3]
-
-                unionw = min(dx2,gx2)-max(dx1,gx1)
-                if unionw <= 0:
-                    continue
-                unionh = min(dy2,gy2)-max(dy1,gy1)
-                if unionh <= 0:
-                    continue
-                t = unionw * unionh
-                if pyiscrowd[j]:
-                    unionarea = darea
-                else:
-                    unionarea = darea + garea - t
-
-                ious[i, j] = float(t)/unionarea
-        return ious
+        # changed by hui, broadcast instead of the loop over all (gt, dt), union area of crowd (ignore) gt is det area
+        from huicv.evaluation.bbox_overlaps import xywh_iou_and_iod
+        ious, iods = xywh_iou_and_iod(dts, gts)
+        pyiscrowd = np.asarray(pyiscrowd).astype(bool).reshape((-1,))
+        return np.where(pyiscrowd[None, :], iods, ious)
+
+    # add by hui
+    def iou_and_iod(self, dts, gts):
+        '''
+        broadcast version of self.iou for all non crowd gts (iou) and all crowd gts (iod, inter / det_area),
+        same element-wise ops as the loop in self.iou
+        '''
+        from huicv.evaluation.bbox_overlaps import xywh_iou_and_iod
+        return xywh_iou_and_iod(dts, gts)
 
     # ###### add by hui
     def IOD(self, dets, ignore_gts):
-        def insect_boxes(box1, boxes):
-            sx1, sy1, sx2, sy2 = box1[:4]
-            tx1, ty1, tx2, ty2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
-            ix1 = np.where(tx1 > sx1, tx1, sx1)
-            iy1 = np.where(ty1 > sy1, ty1, sy1)
-            ix2 = np.where(tx2 < sx2, tx2, sx2)
-            iy2 = np.where(ty2 < sy2, ty2, sy2)
-            return np.array([ix1, iy1, ix2, iy2]).transpose((1, 0))
-
-        def bbox_area(boxes):
-            s = np.zeros(shape=(boxes.shape[0],), dtype=np.float32)
-            tx1, ty1, tx2, ty2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
-            h = (tx2 - tx1)
-            w = (ty2 - ty1)
-            valid = np.all(np.array([h > 0, w > 0]), axis=0)
-            s[valid] = (h * w)[valid]
-            return s
-
-        def bbox_iod(dets, gts, eps=1e-12):
-            iods = np.zeros(shape=(dets.shape[0], gts.shape[0]), dtype=np.float32)
-            dareas = bbox_area(dets)
-            for i, (darea, det) in enumerate(zip(dareas, dets)):
-                idet = insect_boxes(det, gts)
-                iarea = bbox_area(idet)
-                iods[i, :] = iarea / (darea + eps)
-            return iods
-
         def xywh2xyxy(boxes):
             boxes[:, 2] += boxes[:, 0]
             boxes[:, 3] += boxes[:, 1]
             return boxes
         from copy import deepcopy
-        return bbox_iod(xywh2xyxy(deepcopy(dets)), xywh2xyxy(deepcopy(ignore_gts)))
+        from huicv.evaluation.bbox_overlaps import bbox_overlaps
+        return bbox_overlaps(xywh2xyxy(deepcopy(dets)), xywh2xyxy(deepcopy(ignore_gts)), 'iod')
 
     def IOD_by_IOU(self, dets, ignore_gts, ignore_gts_area, ious):
         if ignore_gts_area is None:
@@ -484,11 +576,10 @@ class COCOeval:
                 # fps = fps[:,inds]
                 """" """
 
-                tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
                 for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
-                    tp = np.array(tp)
-                    fppi = np.array(fp)/I0
+                    fppi = fp / I0
                     nd = len(tp)
                     recall = tp / npig
                     q = np.zeros((R,))
@@ -511,22 +602,14 @@ class COCOeval:
 #                     print("fppi == 0.1, score ==", fppi01_score, file=sys.stderr)
 #######################################################################################################
 
-                    # numpy is slow without cython optimization for accessing elements
-                    # use python array gets significant speed improvement
-                    recall = recall.tolist()
-                    q = q.tolist()
-
-                    for i in range(nd - 1, 0, -1):
-                        if recall[i] < recall[i - 1]:
-                            recall[i - 1] = recall[i]
-
-                    inds = np.searchsorted(fppi, p.fppiThrs, side='right') - 1
-                    try:
-                        for ri, pi in enumerate(inds):
-                            q[ri] = recall[pi]
-                    except:
-                        pass
-                    ys[t,:,k,m] = np.array(q)
+                    # changed by hui, recall[i-1] = min(recall[i-1], recall[i]) from back to front and
+                    # q[ri] = recall[inds[ri]] in numpy instead of python list, inds of -1 (fppiThr < fppi[0]) still
+                    # take recall[-1] as the list index did, q keeps 0 if no det (the IndexError caught before).
+                    if nd > 0:
+                        recall = np.minimum.accumulate(recall[::-1])[::-1]
+                        inds = np.searchsorted(fppi, p.fppiThrs, side='right') - 1
+                        q = recall[inds]
+                    ys[t,:,k,m] = q
         self.eval = {
             'params': p,
             'counts': [T, R, K, M],
@@ -537,11 +620,15 @@ class COCOeval:
         print('DONE (t={:0.2f}s).'.format(toc-tic))
         print('number of gt boxes: {}'.format(add_gts_count))
 
-    def summarize(self,id_setup, res_file):
+    def summarize(self,id_setup, res_file=None, print_func=print):
         '''
         Compute and display summary metrics for evaluation results.
         Note this functin can *only* be applied on the default parameter setting
+        :param res_file: opened file to write the summary lines, None to not write.
+        :param print_func: None to not print.
+        :return: OrderedDict of {'MR{iou*100}_{setup}': MR(%)}, e.g. 'MR50_tiny1', same value as printed.
         '''
+        metrics = OrderedDict()
         def _summarize(iouThr=None, maxDets=100 ):
             p = self.params
             iStr = ' {:<18} {} @ {:<18} [ IoU={:<9} | height={:>6s} | visibility={:>6s} ] = {:0.2f}%'
@@ -570,10 +657,13 @@ class COCOeval:
                 mean_s = np.mean(mean_s)
                 mean_s = np.exp(mean_s)
 
-            print(mrs.shape)#, mean_s >= 0.1)
-            print(iStr.format(titleStr, typeStr,setupStr, iouStr, heightStr, occlStr, mean_s*100))
-            res_file.write(iStr.format(titleStr, typeStr,setupStr, iouStr, heightStr, occlStr, mean_s*100))
-            res_file.write('\n')
+            if print_func is not None:
+                print_func(mrs.shape)#, mean_s >= 0.1)
+                print_func(iStr.format(titleStr, typeStr,setupStr, iouStr, heightStr, occlStr, mean_s*100))
+            if res_file is not None:
+                res_file.write(iStr.format(titleStr, typeStr,setupStr, iouStr, heightStr, occlStr, mean_s*100))
+                res_file.write('\n')
+            metrics['MR{:d}_{}'.format(int(round(iouThr * 100)), setupStr)] = float(mean_s * 100)
             return mean_s
 
         if not self.eval:
@@ -581,6 +671,22 @@ class COCOeval:
         # _summarize(iouThr=.5,maxDets=1000)
         for iouThr in self.params.iouThrs:
             _summarize(iouThr=iouThr,maxDets=1000)
+        return metrics
+
+    # add by hui
+    def summarize_all_setups(self, evalImgs_of_setups, res_file=None, print_func=print):
+        '''
+        accumulate and summarize each setup of evalImgs_of_setups (returned by evaluate_all_setups).
+        :return: OrderedDict of {setup label: OrderedDict of {iouThr: MR(%)}}, e.g. mrs['tiny1'][0.5]
+        '''
+        mr_of_setups = OrderedDict()
+        for id_setup, evalImgs in evalImgs_of_setups.items():
+            self.evalImgs = evalImgs
+            self.accumulate()
+            metrics = self.summarize(id_setup, res_file, print_func)
+            mr_of_setups[self.params.SetupLbl[id_setup]] = OrderedDict(
+                zip([float(iouThr) for iouThr in self.params.iouThrs], metrics.values()))
+        return mr_of_setups
 
     def __str__(self):
         self.summarize()
@@ -606,6 +712,7 @@ class Params:
     TINY_SCALE = 1
     IOU_THS = None
     def setDetParams(self):
+        CUT_WH, IOU_THS, TINY_SCALE = self.cut_wh, self.iou_ths, self.tiny_scale  # add by hui
         self.imgIds = []
         self.catIds = []
 
@@ -614,22 +721,22 @@ class Params:
         # np.array([0.0100, 0.0178, 0.0316, 0.0562, 0.1000, 0.1778, 0.3162, 0.5623, 1.0000])
         # self.fppiThrs = get_fppi(0.01, 8., 9) / Params.CUT_WH[0] / Params.CUT_WH[1]
         # self.fppiThrs = get_fppi(0.01, 1., 9) * 8/ Params.CUT_WH[0] / Params.CUT_WH[1] #
-        self.fppiThrs = get_fppi(0.01, 1., 9) / Params.CUT_WH[0] / Params.CUT_WH[1] #
+        self.fppiThrs = get_fppi(0.01, 1., 9) / CUT_WH[0] / CUT_WH[1] #
         #########################################################################################################
         self.maxDets = [1000]
         self.expFilter = 1.25
         self.useCats = 1
 
-        if Params.CITYPERSON_STANDARD:
-            self.iouThrs = np.array([0.5, 0.75])  if Params.IOU_THS is None else np.array(Params.IOU_THS) # np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
+        if self.citypersons_standard:
+            self.iouThrs = np.array([0.5, 0.75])  if IOU_THS is None else np.array(IOU_THS) # np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
 
             self.HtRng = [[50, 1e5 ** 2], [50,75], [50, 1e5 ** 2], [20, 1e5 ** 2], [20, 50]]
             self.VisRng = [[0.65, 1e5 ** 2], [0.65, 1e5 ** 2], [0.2,0.65], [0.2, 1e5 ** 2], [0.65, 1e5 ** 2]]
             self.SetupLbl = ['Reasonable', 'Reasonable_small','Reasonable_occ=heavy', 'All', 'small']
         else:
-            self.iouThrs = np.array([0.25, 0.5, 0.75]) if Params.IOU_THS is None else np.array(Params.IOU_THS)
+            self.iouThrs = np.array([0.25, 0.5, 0.75]) if IOU_THS is None else np.array(IOU_THS)
 
-            s = Params.TINY_SCALE
+            s = TINY_SCALE
             self.HtRng = [[2*s, 8*s], [8*s, 12*s], [12*s, 20*s], [2*s, 20*s], [20*s, 32*s], [-1, 1e5**2]]
             # self.HtRng = [[-1, 8], [8, 12], [12, 20], [-1, 20], [20, 32], [-1, 1e5**2]]
             # self.HtRng = [[40, 1e5 ** 2], [40, 1e5**2], [40,100], [-1, 40], [-1, 1e5**2]]
@@ -642,7 +749,13 @@ class Params:
             # self.VisRng = [[0.65, 1e5 ** 2] for _ in range(len(self.HtRng))]
             # self.SetupLbl = ['tiny', ]
 
-    def __init__(self, iouType='segm'):
+    def __init__(self, iouType='segm', cut_wh=None, citypersons_standard=None, tiny_scale=None, iou_ths=None):
+        # add by hui, setup of this instance, the class attributes are used if not given,
+        # so evaluations with different setups can run at the same time
+        self.cut_wh = Params.CUT_WH if cut_wh is None else cut_wh
+        self.citypersons_standard = Params.CITYPERSON_STANDARD if citypersons_standard is None else citypersons_standard
+        self.tiny_scale = Params.TINY_SCALE if tiny_scale is None else tiny_scale
+        self.iou_ths = Params.IOU_THS if iou_ths is None else iou_ths
         if iouType == 'segm' or iouType == 'bbox':
             self.setDetParams()
         else:
@@ -0,0 +1,121 @@
+"""
+    pairwise overlap kernels (IoU / IoD / IoG) between two sets of xyxy boxes.
+    the results are float32 and the same as the row-by-row version in visualization/bbox_utils.py,
+    but computed with broadcast over (D, G) blocks instead of a python loop over dets.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError as e:
+    numba = None
+
+
+def bbox_area(boxes):
+    """
+        area of xyxy boxes, 0 for boxes with w <= 0 or h <= 0, return float32 array with the shape of boxes[..., 0]
+    """
+    w = boxes[..., 2] - boxes[..., 0]
+    h = boxes[..., 3] - boxes[..., 1]
+    s = (w * h).astype(np.float32)
+    s[~((w > 0) & (h > 0))] = 0
+    return s
+
+
+def insect_area(dets, gts):
+    """
+        area of intersection between each det and gt, (D, 4) x (G, 4) => (D, G) float32
+    """
+    ix1 = np.maximum(dets[:, None, 0], gts[None, :, 0])
+    iy1 = np.maximum(dets[:, None, 1], gts[None, :, 1])
+    ix2 = np.minimum(dets[:, None, 2], gts[None, :, 2])
+    iy2 = np.minimum(dets[:, None, 3], gts[None, :, 3])
+    w, h = ix2 - ix1, iy2 - iy1
+    s = (w * h).astype(np.float32)
+    s[~((w > 0) & (h > 0))] = 0
+    return s
+
+
+def _overlaps_of_block(iarea, dareas, gareas, mode, eps):
+    if mode == 'iou':
+        return iarea / (dareas[:, None] + gareas[None, :] - iarea + eps)
+    elif mode == 'iod':
+        return iarea / (dareas[:, None] + eps)
+    else:  # iog
+        return iarea / (gareas[None, :] + eps)
+
+
+if numba is not None:
+    @numba.njit
+    def _numba_overlaps(dets, gts, dareas, gareas, mode_id, eps):
+        eps = np.float32(eps)
+        out = np.zeros((dets.shape[0], gts.shape[0]), dtype=np.float32)
+        for i in range(dets.shape[0]):
+            for j in range(gts.shape[0]):
+                w = min(dets[i, 2], gts[j, 2]) - max(dets[i, 0], gts[j, 0])
+                h = min(dets[i, 3], gts[j, 3]) - max(dets[i, 1], gts[j, 1])
+                if w <= 0 or h <= 0:
+                    continue
+                iarea = np.float32(w * h)
+                if mode_id == 0:
+                    out[i, j] = iarea / (dareas[i] + gareas[j] - iarea + eps)
+                elif mode_id == 1:
+                    out[i, j] = iarea / (dareas[i] + eps)
+                else:
+                    out[i, j] = iarea / (gareas[j] + eps)
+        return out
+
+
+_MODE_ID = {'iou': 0, 'iod': 1, 'iog': 2}
+
+
+def bbox_overlaps(dets, gts, mode='iou', eps=1e-12, block_size=4096, use_numba=False):
+    """
+        dets: (D, >=4) xyxy boxes, gts: (G, >=4) xyxy boxes, only the first 4 columns are used.
+        mode: 'iou' => inter / (det_area + gt_area - inter)
+              'iod' => inter / det_area, intersection over det
+              'iog' => inter / gt_area, intersection over gt
+        block_size: max number of det rows computed in one broadcast, peak memory is about block_size * G * 6 float,
+            set None or <= 0 to compute all dets in one pass.
+        use_numba: use the numba jit loop instead of numpy broadcast, fall back to numpy if numba is not installed.
+        return: (D, G) float32
+    """
+    assert mode in _MODE_ID, "mode must be one of {}, but got {}".format(list(_MODE_ID.keys()), mode)
+    dets, gts = np.asarray(dets), np.asarray(gts)
+    out = np.zeros((len(dets), len(gts)), dtype=np.float32)
+    if len(dets) == 0 or len(gts) == 0:
+        return out
+    dets, gts = dets[:, :4], gts[:, :4]
+    dareas, gareas = bbox_area(dets), bbox_area(gts)
+
+    if use_numba and numba is not None:
+        dtype = np.result_type(dets.dtype, gts.dtype, np.float32)
+        return _numba_overlaps(np.ascontiguousarray(dets, dtype=dtype), np.ascontiguousarray(gts, dtype=dtype),
+                               dareas, gareas, _MODE_ID[mode], eps)
+
+    block_size = len(dets) if block_size is None or block_size <= 0 else block_size
+    for s in range(0, len(dets), block_size):
+        iarea = insect_area(dets[s:s + block_size], gts)
+        out[s:s + block_size] = _overlaps_of_block(iarea, dareas[s:s + block_size], gareas, mode, eps)
+    return out
+
+
+def xywh_iou_and_iod(dets, gts):
+    """
+        dets: (D, 4) xywh boxes, gts: (G, 4) xywh boxes
+        return: (D, G) float64 iou and iod (inter / det_area), the element-wise ops are the same as
+            pycocotools maskUtils.iou (bbIou, iod for crowd gts), so the results are bitwise equal to it.
+    """
+    dets = np.asarray(dets, dtype=np.float64).reshape((-1, 4))
+    gts = np.asarray(gts, dtype=np.float64).reshape((-1, 4))
+    dx1, dy1, dw, dh = [dets[:, i:i + 1] for i in range(4)]
+    gx1, gy1, gw, gh = [gts[None, :, i] for i in range(4)]
+    iw = np.minimum(dx1 + dw, gx1 + gw) - np.maximum(dx1, gx1)
+    ih = np.minimum(dy1 + dh, gy1 + gh) - np.maximum(dy1, gy1)
+    valid = np.logical_and(iw > 0, ih > 0)
+    inter = iw * ih
+    darea, garea = dw * dh, gw * gh
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = np.where(valid, inter / (darea + garea - inter), 0.)
+        iods = np.where(valid, inter / darea, 0.)
+    return ious, iods
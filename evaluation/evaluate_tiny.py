@@ -1,11 +1,16 @@
 from pycocotools.coco import COCO
 import os
+import csv
+import glob
+import json
 import argparse
 import sys
 import shutil
 from huicv.deps.Cityscapes.cityperson_eval import cityperson_eval
 from collections import OrderedDict
-from huicv.evaluation.expand_cocofmt_eval import COCOExpandEval
+from huicv.evaluation.expand_cocofmt_eval import COCOExpandEval, PreparedGts
+from huicv.evaluation.iou_cache import IoUCache
+from huicv.evaluation.multi_process import multiprocess_map
 
 
 """
@@ -19,6 +24,10 @@ run example:
     python huicv/evaluation/evaluate_tiny.py --res exp/latest_result.json \
         --gt data/tiny_set/annotations/corner/task/tiny_set_test_sw640_sh512_all.json \
         --merge-gt data/tiny_set/mini_annotations/tiny_set_test_all.json --detail
+
+batch example (gt is loaded once, result files are evaluated in a pool of all cpu, one row for each file):
+    python huicv/evaluation/evaluate_tiny.py --res "exp/epoch_*.bbox.json,exp/latest_result.json" \
+        --gt data/tiny_set/mini_annotations/tiny_set_test_all.json --score-file exp/scores.csv --num-process -1
 """
 
 
@@ -125,9 +134,15 @@ def merge_det_result(json_result_file, corner_gt_file, merged_gt_file, merge_nms
 
 def evaluate_ap(json_result_file, gt_file,
                 iou_types=("bbox",), expected_results=(), expected_results_sigma_tol=4,
-                iou_type="bbox", ignore_uncertain=False, use_iod_for_ignore=False, eval_standard='tiny'):
-    coco_gt = COCO(gt_file)
-    coco_dt = coco_gt.loadRes(str(json_result_file))
+                iou_type="bbox", ignore_uncertain=False, use_iod_for_ignore=False, eval_standard='tiny',
+                iou_cache_dir=None, coco_gt=None, coco_dt=None, iou_cache=None, prepared_gts=None, return_metrics=False):
+    """
+        return_metrics: if True, return OrderedDict of AP/AR metrics (see COCOExpandEval.summarize)
+            instead of COCOResults.
+    """
+    if coco_gt is None or coco_dt is None:
+        coco_gt = COCO(gt_file)
+        coco_dt = coco_gt.loadRes(str(json_result_file))
 
     # tiny evaluation
     cocofmt_kwargs=dict(
@@ -142,11 +157,18 @@ def evaluate_ap(json_result_file, gt_file,
         )
     )
 
+    if prepared_gts is not None:
+        cocofmt_kwargs['prepared_gts'] = prepared_gts
+    if iou_cache is not None:
+        cocofmt_kwargs['iou_cache'] = iou_cache
+    elif iou_cache_dir is not None:
+        cocofmt_kwargs['iou_cache'] = IoUCache.from_files(iou_cache_dir, gt_file, json_result_file)
+
     cocoEval = COCOExpandEval(coco_gt, coco_dt, iou_type, **cocofmt_kwargs)
     print(cocoEval.params.__dict__)
     cocoEval.evaluate()
     cocoEval.accumulate()
-    cocoEval.summarize()
+    metrics = cocoEval.summarize()
 
     # coco_dt = coco_gt.loadRes(coco_results)
     # Params.EVAL_STRANDARD = eval_standard
@@ -160,15 +182,154 @@ def evaluate_ap(json_result_file, gt_file,
     results.update(cocoEval)
 
     check_expected_results(results, expected_results, expected_results_sigma_tol)
+    if return_metrics:
+        return metrics
     return results
 
 
 # only support merged det_file and merged_gt_file
 def evaluate_mr(merged_det_file, merged_gt_file,
-                ignore_uncertain=False, use_iod_for_ignore=False, iou_ths=None, setup_labels=None):
+                ignore_uncertain=False, use_iod_for_ignore=False, iou_ths=None, setup_labels=None, iou_cache_dir=None,
+                num_process=1):
+    """
+        num_process: number of processes to evaluate the setups, -1 use all cpu.
+        return: OrderedDict of MR(%) of all setups, see cityperson_eval
+    """
     return cityperson_eval(merged_det_file, merged_gt_file, CUT_WH=(1, 1),
                            ignore_uncertain=ignore_uncertain, use_iod_for_ignore=use_iod_for_ignore,
-                           use_citypersons_standard=False, iou_ths=iou_ths, setup_labels=setup_labels)
+                           use_citypersons_standard=False, iou_ths=iou_ths, setup_labels=setup_labels,
+                           iou_cache_dir=iou_cache_dir, num_process=num_process)
+
+
+def evaluate_ap_mr(det_file, gt_file, ignore_uncertain=False, use_iod_for_ignore=False, eval_standard='tiny',
+                   iou_ths=None, setup_labels=None, iou_cache_dir=None, coco_gt=None, prepared_gts=None, metric='all',
+                   num_process=1):
+    """
+        evaluate AP and MR of all setups in one pass, same results as evaluate_ap + evaluate_mr, but gt and det files
+        are loaded once, and the bbox iou/iod of each (imgId, catId) are computed once and shared by the AP evaluation
+        and all MR setups (through an IoUCache, kept in memory if iou_cache_dir is None).
+        coco_gt, prepared_gts: loaded COCO of gt_file and its PreparedGts, to evaluate many det files with one gt,
+            prepared_gts must be built before any MR evaluation on coco_gt, which changes the 'ignore' of gt anns.
+        metric: 'all', 'ap' or 'mr'
+        num_process: number of processes to evaluate the MR setups, -1 use all cpu.
+        return: OrderedDict of AP/AR metrics followed by MR metrics
+    """
+    assert metric in ['all', 'ap', 'mr'], "metric must be 'ap', 'mr' or 'all', but got {}".format(metric)
+    if coco_gt is None:
+        coco_gt = COCO(gt_file)
+    coco_dt = coco_gt.loadRes(str(det_file))
+    if iou_cache_dir is not None:
+        iou_cache = IoUCache.from_files(iou_cache_dir, gt_file, det_file)
+    else:
+        iou_cache = IoUCache()
+    metrics = OrderedDict()
+    # AP first, the MR evaluation sets the ignore flag of each setup to the gt anns
+    if metric == 'all' or metric == 'ap':
+        metrics.update(evaluate_ap(det_file, gt_file, ignore_uncertain=ignore_uncertain,
+                                   use_iod_for_ignore=use_iod_for_ignore, eval_standard=eval_standard,
+                                   coco_gt=coco_gt, coco_dt=coco_dt, iou_cache=iou_cache, prepared_gts=prepared_gts,
+                                   return_metrics=True))
+    if metric == 'all' or metric == 'mr':
+        metrics.update(cityperson_eval(det_file, gt_file, CUT_WH=(1, 1),
+                                       ignore_uncertain=ignore_uncertain, use_iod_for_ignore=use_iod_for_ignore,
+                                       use_citypersons_standard=False, iou_ths=iou_ths, setup_labels=setup_labels,
+                                       cocoGt=coco_gt, cocoDt=coco_dt, iou_cache=iou_cache, num_process=num_process))
+    return metrics
+
+
+# gt_file => (coco_gt, prepared_gts), loaded in main process before the worker processes are forked,
+# so the workers of evaluate_batch use it without loading or pickling the gt again.
+_batch_gts = {}
+
+
+def load_batch_gt(gt_file):
+    if gt_file not in _batch_gts:
+        coco_gt = COCO(gt_file)
+        _batch_gts[gt_file] = (coco_gt, PreparedGts(coco_gt))
+    return _batch_gts[gt_file]
+
+
+def _evaluate_batch_item(res_file, gt_file, corner_gt_file, eval_kwargs):
+    if corner_gt_file is not None:
+        _, res_file = merge_det_result(res_file, corner_gt_file, gt_file, merge_nms_th=0.5)
+    coco_gt, prepared_gts = load_batch_gt(gt_file)
+    return evaluate_ap_mr(res_file, gt_file, coco_gt=coco_gt, prepared_gts=prepared_gts, **eval_kwargs)
+
+
+def evaluate_batch(res_files, gt_file, corner_gt_file=None, num_process=-1, **eval_kwargs):
+    """
+        evaluate many result files (e.g. checkpoints of one experiment) with the same gt_file by evaluate_ap_mr,
+        gt is loaded once in main process, and the result files are evaluated in num_process worker processes.
+        corner_gt_file: if given, res_files are results of corner (sub) images and are merged to gt_file first.
+        eval_kwargs: args of evaluate_ap_mr.
+        return: OrderedDict of {res_file: metrics}
+    """
+    load_batch_gt(gt_file)
+    args_list = [(res_file, gt_file, corner_gt_file, eval_kwargs) for res_file in res_files]
+    results = multiprocess_map(_evaluate_batch_item, args_list, num_process=num_process)
+    return OrderedDict(zip(res_files, results))
+
+
+def parse_res_files(res):
+    """
+        res: ',' separated result files or glob patterns, e.g. 'exp/epoch_*.json,exp/latest.json'
+    """
+    res_files = []
+    for pattern in res.split(','):
+        pattern = pattern.strip()
+        if len(pattern) == 0:
+            continue
+        if any(c in pattern for c in '*?['):
+            res_files.extend(sorted(glob.glob(pattern)))
+        else:
+            res_files.append(pattern)
+    return res_files
+
+
+def write_metrics(metrics, file_name):
+    """
+        write {name: value} metrics to file_name, format is chosen by the extension:
+            .json: json dict, .csv: 'metric,value' rows, others: 'name: value' lines.
+    """
+    ext = os.path.splitext(file_name)[-1].lower()
+    with open(file_name, 'w') as f:
+        if ext == '.json':
+            json.dump(metrics, f, indent=2)
+        elif ext == '.csv':
+            writer = csv.writer(f)
+            writer.writerow(['metric', 'value'])
+            for k, v in metrics.items():
+                writer.writerow([k, float(v)])
+        else:
+            for k, v in metrics.items():
+                f.write("{}: {}\n".format(k, float(v)))
+
+
+def write_metrics_table(metrics_of_files, file_name):
+    """
+        write {res_file: {name: value}} as a comparison table with one row for each result file,
+        format is chosen by the extension: .json: json dict, .csv: csv with header 'res_file' + metric names,
+        others: aligned text table.
+    """
+    names = list(OrderedDict((k, None) for metrics in metrics_of_files.values() for k in metrics).keys())
+    ext = os.path.splitext(file_name)[-1].lower()
+    with open(file_name, 'w') as f:
+        if ext == '.json':
+            json.dump(metrics_of_files, f, indent=2)
+        elif ext == '.csv':
+            writer = csv.writer(f)
+            writer.writerow(['res_file'] + names)
+            for res_file, metrics in metrics_of_files.items():
+                writer.writerow([res_file] + [float(metrics[k]) if k in metrics else '' for k in names])
+        else:
+            w = max([len('res_file')] + [len(res_file) for res_file in metrics_of_files])
+            col_w = [max(len(k), 8) for k in names]
+            f.write(' '.join(['{:<{}}'.format('res_file', w)] + ['{:>{}}'.format(k, cw) for k, cw in zip(names, col_w)]))
+            f.write('\n')
+            for res_file, metrics in metrics_of_files.items():
+                values = ['{:.4f}'.format(metrics[k]) if k in metrics else '-' for k in names]
+                f.write(' '.join(['{:<{}}'.format(res_file, w)] + ['{:>{}}'.format(v, cw) for v, cw in zip(values, col_w)]))
+                f.write('\n')
 
 
 class RedirectStdOut(object):
@@ -195,64 +356,80 @@ def rm_file(file_name):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='evaluate AP and MR for Tiny Benchmark.')
-    parser.add_argument('--res', dest='res', required=True, help='result file of detetor.')
+    parser.add_argument('--res', dest='res', required=True,
+                        help='result file of detetor, or "," separated files/glob patterns to evaluate in batch.')
     parser.add_argument('--gt', dest='gt', required=True, help='ground-truth file.')
     parser.add_argument('--merge-gt', dest='merge_gt', help='merged ground truth file.', default='')
     parser.add_argument('--metric', dest='metric', help='merged ground truth file.', default='all')
-    parser.add_argument('--score-file', dest='score_file', help='output score file.', default='')
-    parser.add_argument('--tmp-log', dest='tmp_log', help='temporal log file.', default='')
+    parser.add_argument('--score-file', dest='score_file', default='',
+                        help='output score file, .json/.csv, or "name: value" lines for other extensions.')
+    parser.add_argument('--tmp-log', dest='tmp_log', help='evaluation log file, only saved with --detail.', default='')
     parser.add_argument('--mr-ious', dest='mr_ious', help='iou th settings while evaluating MR.',
                         default='0.25,0.5,0.75')
     parser.add_argument('--mr-sizes', dest='mr_sizes', help='size settings while evaluating MR.',
                         default='tiny1,tiny2,tiny3,tiny,small,All')
-    parser.add_argument('--detail', dest='detail', help='output detail info in result file', action='store_true')
+    parser.add_argument('--detail', dest='detail', help='save the evaluation log to --tmp-log', action='store_true')
+    parser.add_argument('--iou-cache-dir', dest='iou_cache_dir', default=None,
+                        help='dir to cache ious of (gt, det) files, re-run with other matching params reuse them.')
+    parser.add_argument('--num-process', dest='num_process', type=int, default=1,
+                        help='number of processes to evaluate result files in batch, or MR setups of one result file, '
+                             '1 (default) to evaluate in current process, -1 to use all cpu.')
     #     json_result_file = '/home/hui/桌面/11.pkl.bbox.json'
     #     corner_gt_file = "/home/hui/dataset/tiny_set/annotations/corner/task/tiny_set_test_sw640_sh512_all.json"
     #     merged_gt_file = '/home/hui/dataset/tiny_set/annotations/task/tiny_set_test_all.json'
 
     args = parser.parse_args()
+    res_files = parse_res_files(args.res)
+    assert len(res_files) > 0, "no result file matched {}".format(args.res)
     if len(args.tmp_log) == 0:
-        args.tmp_log = os.path.join(os.path.dirname(args.res), 'tmp.log')
+        args.tmp_log = os.path.join(os.path.dirname(res_files[0]), 'tmp.log')
     if len(args.score_file) == 0:
-        args.score_file = os.path.join(os.path.dirname(args.res), 'scores.txt')
+        args.score_file = os.path.join(os.path.dirname(res_files[0]), 'scores.txt' if len(res_files) == 1 else 'scores.csv')
+
+    metric = args.metric.lower()
+    iou_ths = [float(x) for x in args.mr_ious.split(',') if len(x.strip()) > 0]
+    setup_labels = [x.strip() for x in args.mr_sizes.split(',') if len(x.strip()) > 0]
+    batch = len(res_files) > 1
 
-    # merge res if needed.
+    # merge res if needed (merged in worker processes for batch).
     if len(args.merge_gt) > 0:
-        _, det_file = merge_det_result(args.res, args.gt, args.merge_gt, merge_nms_th=0.5)
-        print(det_file)
-        gt_file = args.merge_gt
+        if not batch:
+            _, det_file = merge_det_result(res_files[0], args.gt, args.merge_gt, merge_nms_th=0.5)
+            print(det_file)
+        gt_file, corner_gt_file = args.merge_gt, args.gt
     else:
-        det_file, gt_file = args.res, args.gt
-
-    # evaluate and redirect output to tmp file
-    rstdout = RedirectStdOut(args.tmp_log)
-    rstdout.start()
+        det_file, gt_file, corner_gt_file = res_files[0], args.gt, None
+
+    # metrics are returned by the evaluators, the log is only saved for --detail
+    if args.detail:
+        rstdout = RedirectStdOut(args.tmp_log)
+        rstdout.start()
+
+    if batch:
+        # one row of the score table for each result file
+        metrics_of_files = evaluate_batch(res_files, gt_file, corner_gt_file=corner_gt_file,
+                                          num_process=args.num_process, metric=metric, ignore_uncertain=True,
+                                          use_iod_for_ignore=True, eval_standard='tiny', iou_ths=iou_ths,
+                                          setup_labels=setup_labels, iou_cache_dir=args.iou_cache_dir)
+    elif metric == 'all':
+        metrics = evaluate_ap_mr(det_file, gt_file, ignore_uncertain=True, use_iod_for_ignore=True, eval_standard='tiny',
+                                 iou_ths=iou_ths, setup_labels=setup_labels, iou_cache_dir=args.iou_cache_dir,
+                                 num_process=args.num_process)
+    elif metric == 'ap':
+        metrics = evaluate_ap(det_file, gt_file, ignore_uncertain=True, use_iod_for_ignore=True, eval_standard='tiny',
+                              iou_cache_dir=args.iou_cache_dir, return_metrics=True)
+    elif metric == 'mr':
+        metrics = evaluate_mr(det_file, gt_file, ignore_uncertain=True, use_iod_for_ignore=True, iou_ths=iou_ths,
+                              setup_labels=setup_labels, iou_cache_dir=args.iou_cache_dir, num_process=args.num_process)
+    else:
+        raise ValueError("metric must be 'ap', 'mr' or 'all', but got {}".format(args.metric))
 
-    metric = args.metric.lower()
-    if metric == 'ap' or metric == 'all':
-        results = evaluate_ap(det_file, gt_file, ignore_uncertain=True, use_iod_for_ignore=True, eval_standard='tiny')
-    if metric == 'mr' or metric == 'all':
-        iou_ths = [float(x) for x in args.mr_ious.split(',') if len(x.strip()) > 0]
-        setup_labels = [x.strip() for x in args.mr_sizes.split(',') if len(x.strip()) > 0]
-        evaluate_mr(det_file, gt_file, ignore_uncertain=True, use_iod_for_ignore=True, iou_ths=iou_ths,
-                    setup_labels=setup_labels)
-
-    rstdout.finish()
-    rm_file(os.path.join(os.path.dirname(__file__), 'results.txt'))
-
-    if not args.detail:
-        from MyPackage.visulize.plot_train_log import parse_log, replace_key
-
-        # parse log and write it to score.txt
-        res = parse_log(args.tmp_log)
-        res = replace_key(res)
-        res = {k: v[0] for k, v in res.items() if len(k) < 15}
-        with open(args.score_file, 'w') as f:
-            for k, v in res.items():
-                f.write("{}: {}\n".format(k, float(v)))
-        rm_file(args.tmp_log)
+    if args.detail:
+        rstdout.finish()
+    if batch:
+        write_metrics_table(metrics_of_files, args.score_file)
     else:
-        os.rename(args.tmp_log, args.score_file)
+        write_metrics(metrics, args.score_file)
 
 # # generate ignore
 # jd = json.load(open("/home/hui/dataset/voc/VOC2007/Annotations/pascal_test2007.json"))
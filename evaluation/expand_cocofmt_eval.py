@@ -1,6 +1,10 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from pycocotools.cocoeval import Params, COCOeval
+from pycocotools import mask as maskUtils
 import numpy as np
+import copy
+from huicv.evaluation.bbox_overlaps import bbox_overlaps
+from huicv.evaluation.multi_process import multiprocess_map, split_shards, get_num_process
 
 
 class ExpandParam(Params):
@@ -65,6 +69,63 @@ class ExpandParam(Params):
             self.__dict__[key] = value
 
 
+def ann_to_rle(ann, h, w):
+    """
+        same as COCO.annToRLE, but take image size as args.
+    """
+    segm = ann['segmentation']
+    if type(segm) == list:
+        # polygon -- a single object might consist of multiple parts
+        # we merge all parts into one mask rle code
+        rles = maskUtils.frPyObjects(segm, h, w)
+        rle = maskUtils.merge(rles)
+    elif type(segm['counts']) == list:
+        # uncompressed RLE
+        rle = maskUtils.frPyObjects(segm, h, w)
+    else:
+        # rle
+        rle = ann['segmentation']
+    return rle
+
+
+class PreparedGts(object):
+    """
+        array-backed gts of a COCO object, built once and shared by evaluations with different params/flags.
+        for each (imgId, catId) a record dict holds read-only arrays of
+            'id', 'bbox' (xywh), 'area', 'iscrowd', 'ignore', 'uncertain', 'num_keypoints'
+        and 'anns', the tuple of origin ann dicts (used by segm/keypoints iou), the ann dicts are never modified.
+        missing 'iscrowd'/'ignore'/'uncertain' are set as 0 (lvis has no 'iscrowd'), missing 'num_keypoints' as -1.
+    """
+    def __init__(self, coco):
+        self.coco = coco
+        anns_of_key = defaultdict(list)
+        for ann in coco.dataset.get('annotations', []):  # same order as coco.getAnnIds(imgIds) inside an image
+            anns_of_key[ann['image_id'], ann['category_id']].append(ann)
+        self.records = {key: self.build_record(anns) for key, anns in anns_of_key.items()}
+
+    @staticmethod
+    def build_record(anns):
+        record = {
+            'id': np.array([ann['id'] for ann in anns]),
+            'bbox': np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape((-1, 4)),
+            'area': np.array([ann['area'] for ann in anns], dtype=np.float64),
+            'iscrowd': np.array([bool(ann.get('iscrowd', 0)) for ann in anns], dtype=bool),
+            'ignore': np.array([bool(ann.get('ignore', 0)) for ann in anns], dtype=bool),
+            'uncertain': np.array([bool(ann.get('uncertain', 0)) for ann in anns], dtype=bool),
+            'num_keypoints': np.array([ann.get('num_keypoints', -1) for ann in anns]),
+        }
+        for arr in record.values():
+            arr.flags.writeable = False
+        record['anns'] = tuple(anns)
+        return record
+
+    def get(self, imgId, catId):
+        return self.records.get((imgId, catId), None)
+
+    def keys(self):
+        return self.records.keys()
+
+
 class COCOExpandEval(COCOeval):
     """
     some modified:
@@ -75,110 +136,173 @@ class COCOExpandEval(COCOeval):
         if 'uncertain' key set in json file, this flag control whether treat gt['ignore'] of 'uncertain' bbox as True
     3. use_iod_for_ignore
         whether use 'iod' evaluation standard while match with 'ignore' bbox
+    4. num_process, num_image_shards
+        evaluate (catId, image shard) tasks in worker processes, evalImgs keep the same order as the serial run.
+    5. gts are read from PreparedGts arrays, ann dicts of cocoGt are not modified by evaluate(),
+        so evaluate() can be called again with other params or flags on the same cocoGt.
     """
 
     def __init__(self, cocoGt=None, cocoDt=None, iouType='segm',
                  ignore_uncertain=False, use_ignore_attr=False,
                  use_iod_for_ignore=False, iod_th_of_iou_f="lambda iou: iou",
-                 cocofmt_param={}):  # add by hui
+                 cocofmt_param={}, num_process=1, num_image_shards=None, batch_area_rng=True,
+                 prepared_gts=None, iou_cache=None):  # add by hui
         """
             iod_th_of_iou_f=lambda iou: iou, use same th of iou as th of iod
             iod_th_of_iou_f=lambda iou: (2*iou)/(1+iou), iou = I/(I+xD+xG), iod=I/(I+xD),
             we assume xD=xG, then iod=(2*iou)/(1+iou)
+            num_process: 0/1 evaluate in current process, -1 use all cpu.
+            num_image_shards: number of image shards of each category while num_process > 1, default 4 * num_process.
+            batch_area_rng: evaluate all areaRng of an (imgId, catId) in one pass by evaluateImgAllArea,
+                set False to call evaluateImg for each areaRng.
+            prepared_gts: PreparedGts of cocoGt, built in the first evaluate() if not given, pass the same one to
+                evaluators of the same cocoGt to avoid re-building it.
+            iou_cache: IoUCache (huicv.evaluation.iou_cache) of (gt file, det file), ious are read from it if cached,
+                otherwise computed and saved to it at the end of evaluate().
         """
         super(COCOExpandEval, self).__init__(cocoGt, cocoDt, iouType)
         self.use_ignore_attr = use_ignore_attr
         self.use_iod_for_ignore = use_iod_for_ignore
         self.ignore_uncertain = ignore_uncertain
+        self.iod_th_of_iou_f_str = iod_th_of_iou_f
         self.iod_th_of_iou_f = eval(iod_th_of_iou_f)
+        self.num_process = num_process
+        self.num_image_shards = num_image_shards
+        self.batch_area_rng = batch_area_rng
+        self.prepared_gts = prepared_gts
+        self.iou_cache = iou_cache
         self.params = ExpandParam(iouType=iouType, **cocofmt_param)  # parameters
         if not cocoGt is None:
             self.params.imgIds = sorted(cocoGt.getImgIds())
             self.params.catIds = sorted(cocoGt.getCatIds())
 
+    def __getstate__(self):
+        # lambda can not be pickled, pass the str to worker process and eval it again
+        state = self.__dict__.copy()
+        state['iod_th_of_iou_f'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.iod_th_of_iou_f = eval(self.iod_th_of_iou_f_str)
+
     def _prepare(self):
         '''
         Prepare ._gts and ._dts for evaluation based on params
+        ._gt_arrays[imgId, catId]: arrays of PreparedGts record, with 'ignore' replaced by the ignore flag used in
+            evaluation, new arrays are created, the record and ann dicts are not modified.
         :return: None
         '''
-        def _toMask(anns, coco):
-            # modify ann['segmentation'] by reference
-            for ann in anns:
-                rle = coco.annToRLE(ann)
-                ann['segmentation'] = rle
         p = self.params
+        if self.prepared_gts is None or self.prepared_gts.coco is not self.cocoGt:
+            self.prepared_gts = PreparedGts(self.cocoGt)
         if p.useCats:
-            gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
             dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
         else:
-            gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
             dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
 
-        # convert ground truth to mask if iouType == 'segm'
-        if p.iouType == 'segm':
-            _toMask(gts, self.cocoGt)
-            _toMask(dts, self.cocoDt)
-        # set ignore flag
-        for gt in gts:
+        imgIds, catIds = set(p.imgIds), set(p.catIds)
+        # (height, width) to convert segmentation to rle, so computeIoU does not need the COCO objects
+        self._img_sizes = {imgId: (img['height'], img['width']) for imgId, img in self.cocoGt.imgs.items()
+                           if imgId in imgIds} if p.iouType == 'segm' else {}
+        self._gts = defaultdict(list)       # gt for evaluation
+        self._gt_arrays = {}
+        for key in self.prepared_gts.keys():
+            if key[0] not in imgIds or (p.useCats and key[1] not in catIds):
+                continue
+            record = self.prepared_gts.get(*key)
+            # set ignore flag
             if self.use_ignore_attr:
-                gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
-                gt['ignore'] = ('iscrowd' in gt and gt['iscrowd']) or gt['ignore']  # changed by hui
+                ignore = np.logical_or(record['iscrowd'], record['ignore'])  # changed by hui
             else:
-                gt['ignore'] = 'iscrowd' in gt and gt['iscrowd']
-            if 'iscrowd' not in gt:  # for mask evaluation of lvis
-                gt['iscrowd'] = 0
-
+                ignore = record['iscrowd'].copy()
             # ########################################################### change by hui ###############################
-            if self.ignore_uncertain and 'uncertain' in gt and gt['uncertain']:
-                gt['ignore'] = 1
+            if self.ignore_uncertain:
+                ignore = np.logical_or(ignore, record['uncertain'])
             # ########################################################### change by hui ###############################
             if p.iouType == 'keypoints':
-                gt['ignore'] = (gt['num_keypoints'] == 0) or gt['ignore']
-        self._gts = defaultdict(list)       # gt for evaluation
+                ignore = np.logical_or(ignore, record['num_keypoints'] == 0)
+            self._gts[key] = list(record['anns'])
+            self._gt_arrays[key] = {'id': record['id'], 'bbox': record['bbox'], 'area': record['area'],
+                                    'iscrowd': record['iscrowd'], 'ignore': ignore}
         self._dts = defaultdict(list)       # dt for evaluation
-        for gt in gts:
-            self._gts[gt['image_id'], gt['category_id']].append(gt)
         for dt in dts:
             self._dts[dt['image_id'], dt['category_id']].append(dt)
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
+    def get_gt_arrays(self, imgId, catId):
+        """
+            gt arrays of (imgId, catId), concatenate all catIds while useCats=0, same order as
+            self._gts[imgId, catId] (or [_ for cId in p.catIds for _ in self._gts[imgId, cId]])
+        """
+        p = self.params
+        keys = [(imgId, catId)] if p.useCats else [(imgId, cId) for cId in p.catIds]
+        records = [self._gt_arrays[key] for key in keys if key in self._gt_arrays]
+        if len(records) == 1:
+            return records[0]
+        elif len(records) == 0:
+            return {'id': np.zeros((0,), dtype=np.int64), 'bbox': np.zeros((0, 4)), 'area': np.zeros((0,)),
+                    'iscrowd': np.zeros((0,), dtype=bool), 'ignore': np.zeros((0,), dtype=bool)}
+        return {k: np.concatenate([r[k] for r in records]) for k in records[0]}
+
+    def computeIoU(self, imgId, catId):
+        """
+            same as COCOeval.computeIoU, but read gt bbox and iscrowd from arrays, and convert segmentation to
+            rle without writing it back to the ann dicts.
+        """
+        p = self.params
+        gt = self.get_gt_arrays(imgId, catId)
+        if p.useCats:
+            dt = self._dts[imgId, catId]
+        else:
+            dt = [_ for cId in p.catIds for _ in self._dts[imgId, cId]]
+        if len(gt['id']) == 0 and len(dt) == 0:
+            return []
+        inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
+        dt = [dt[i] for i in inds]
+        # ious of all dets are cached, the ious of top maxDet dets are the first maxDet rows
+        use_cache = self.iou_cache is not None and len(gt['id']) > 0 and len(dt) > 0
+        if use_cache:
+            cache_name = p.iouType if p.useCats else '{}_cats{}'.format(p.iouType, ','.join(map(str, p.catIds)))
+            if p.iouType == 'bbox':
+                # raw iou and iod are shared with other evaluators (MR), crowd gts use iod as maskUtils.iou
+                ious, iods = self.iou_cache.bbox_iou_and_iod(imgId, catId, [d['bbox'] for d in dt], gt['bbox'],
+                                                             cache_name)
+                return np.where(gt['iscrowd'][None, :], iods, ious)[:p.maxDets[-1]]
+            ious = self.iou_cache.get(imgId, catId, cache_name)
+            if ious is not None and ious.shape == (len(dt), len(gt['id'])):
+                return np.array(ious[:p.maxDets[-1]])
+        elif len(dt) > p.maxDets[-1]:
+            dt = dt[0:p.maxDets[-1]]
+
+        if p.iouType == 'segm':
+            gt_anns = self._gts[imgId, catId] if p.useCats else [_ for cId in p.catIds for _ in self._gts[imgId, cId]]
+            g = [ann_to_rle(g, *self._img_sizes[imgId]) for g in gt_anns]
+            d = [ann_to_rle(d, *self._img_sizes[imgId]) for d in dt]
+        elif p.iouType == 'bbox':
+            g = gt['bbox'].tolist()
+            d = [d['bbox'] for d in dt]
+        else:
+            raise Exception('unknown iouType for iou computation')
+
+        # compute iou between each dt and gt region
+        iscrowd = [int(c) for c in gt['iscrowd']]
+        ious = maskUtils.iou(d, g, iscrowd)
+        if use_cache:
+            self.iou_cache.put(imgId, catId, cache_name, ious)
+            ious = ious[:p.maxDets[-1]]
+        return ious
+
     # ###### add by G
     def IOD(self, dets, ignore_gts):
-        def insect_boxes(box1, boxes):
-            sx1, sy1, sx2, sy2 = box1[:4]
-            tx1, ty1, tx2, ty2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
-            ix1 = np.where(tx1 > sx1, tx1, sx1)
-            iy1 = np.where(ty1 > sy1, ty1, sy1)
-            ix2 = np.where(tx2 < sx2, tx2, sx2)
-            iy2 = np.where(ty2 < sy2, ty2, sy2)
-            return np.array([ix1, iy1, ix2, iy2]).transpose((1, 0))
-
-        def bbox_area(boxes):
-            s = np.zeros(shape=(boxes.shape[0],), dtype=np.float32)
-            tx1, ty1, tx2, ty2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
-            h = (tx2 - tx1)
-            w = (ty2 - ty1)
-            valid = np.all(np.array([h > 0, w > 0]), axis=0)
-            s[valid] = (h * w)[valid]
-            return s
-
-        def bbox_iod(dets, gts, eps=1e-12):
-            iods = np.zeros(shape=(dets.shape[0], gts.shape[0]), dtype=np.float32)
-            dareas = bbox_area(dets)
-            for i, (darea, det) in enumerate(zip(dareas, dets)):
-                idet = insect_boxes(det, gts)
-                iarea = bbox_area(idet)
-                iods[i, :] = iarea / (darea + eps)
-            return iods
-
         def xywh2xyxy(boxes):
             boxes[:, 2] += boxes[:, 0]
             boxes[:, 3] += boxes[:, 1]
             return boxes
 
         from copy import deepcopy
-        return bbox_iod(xywh2xyxy(deepcopy(dets)), xywh2xyxy(deepcopy(ignore_gts)))
+        return bbox_overlaps(xywh2xyxy(deepcopy(dets)), xywh2xyxy(deepcopy(ignore_gts)), 'iod')
 
     # add by hui
     def IOD_by_IOU(self, dets, ignore_gts, ignore_gts_area, ious):
@@ -190,117 +314,136 @@ class COCOExpandEval(COCOeval):
         iods = ious / (1 + ious) * (1 + tile_gts_area / tile_dets_area)
         return iods
 
+    def match_all_thresholds(self, ious, gtIg, iscrowd, gt_ids, dt_ids, ignore_gts_idx=None, ignore_iods=None):
+        """
+            greedy COCO matching of score sorted dets to ignore-last sorted gts, for all iouThrs at once.
+            same result as the (iouThrs x dets x gts) loop of COCOeval.evaluateImg:
+                for each det, a regular gt is the best match if any one satisfies the threshold (the last one
+                if iou ties), otherwise an ignore gt is chosen in the same way; a matched gt can not be
+                matched again unless it is crowd; if nothing matched and use_iod_for_ignore is set, the
+                ignore gt with the max iod is matched if its iod >= iod_th_of_iou_f(iou_th).
+            only the loop over dets is left in python since each det depends on the gts matched before it.
+            ious: (D, G) array, gtIg/iscrowd: (G,), gt_ids: (G,), dt_ids: (D,)
+            ignore_iods: (D, len(ignore_gts_idx)) iod of dets and ignore gts, only used while use_iod_for_ignore
+            return gtm (T, G), dtm (T, D), dtIg (T, D)
+        """
+        p = self.params
+        D, G, T = len(dt_ids), len(gt_ids), len(p.iouThrs)
+        gtm = np.zeros((T, G))
+        dtm = np.zeros((T, D))
+        dtIg = np.zeros((T, D))
+        gtIg = np.asarray(gtIg)
+        gt_ids = np.asarray(gt_ids)
+        not_crowd = np.logical_not(np.asarray(iscrowd, dtype=bool))
+        iou_ths = np.array([min([t, 1 - 1e-10]) for t in p.iouThrs])
+        use_iod = self.use_iod_for_ignore and ignore_iods is not None
+        if use_iod:
+            iod_ths = np.array([self.iod_th_of_iou_f(min([t, 1 - 1e-10])) for t in p.iouThrs])
+        # gts are sorted ignore last, so [0, G0) are regular gts and [G0, G) are ignore gts
+        G0 = int(np.count_nonzero(gtIg == 0))
+        t_range = np.arange(T)
+        for dind in range(D):
+            # gts that already matched and not a crowd can not be matched again
+            cand = np.logical_and(ious[dind][None, :] >= iou_ths[:, None],
+                                  np.logical_not(np.logical_and(gtm > 0, not_crowd[None, :])))
+            values = np.where(cand, ious[dind][None, :], -np.inf)
+            m = np.full((T,), -1)
+            # the last one of max iou of regular gts first, then of ignore gts
+            for s, e in [(G0, G), (0, G0)]:
+                if e > s:
+                    found = cand[:, s:e].any(axis=1)
+                    m = np.where(found, (e - 1) - np.argmax(values[:, e - 1:(s - 1 if s > 0 else None):-1], axis=1), m)
+            if use_iod and (m == -1).any():
+                iods = ignore_iods[dind]
+                idx = np.argmax(iods)
+                m = np.where(np.logical_and(m == -1, iods[idx] >= iod_ths), ignore_gts_idx[idx], m)
+            matched = m > -1
+            tind, m = t_range[matched], m[matched]
+            dtIg[tind, dind] = gtIg[m]
+            dtm[tind, dind] = gt_ids[m]
+            gtm[tind, m] = dt_ids[dind]
+        return gtm, dtm, dtIg
+
     def evaluateImg(self, imgId, catId, aRng, maxDet):
         '''
         perform evaluation for single category and image
         :return: dict (single image results)
         '''
+        return self.evaluateImgAllArea(imgId, catId, [aRng], maxDet)[0]
+
+    def evaluateImgAllArea(self, imgId, catId, areaRngs, maxDet):
+        """
+            evaluate all area ranges of (imgId, catId) in one pass, return [evaluateImg(imgId, catId, aRng, maxDet)
+            for aRng in areaRngs]. dets are sorted and turned to arrays only once for all area ranges,
+            the work of each area range is only re-sorting gts by its ignore mask and matching.
+        """
         p = self.params
+        gt = self.get_gt_arrays(imgId, catId)
         if p.useCats:
-            gt = self._gts[imgId, catId]
             dt = self._dts[imgId, catId]
         else:
-            gt = [_ for cId in p.catIds for _ in self._gts[imgId, cId]]
             dt = [_ for cId in p.catIds for _ in self._dts[imgId, cId]]
-        if len(gt) == 0 and len(dt) == 0:
-            return None
-
-        for g in gt:
-            if g['ignore'] or (g['area'] < aRng[0] or g['area'] > aRng[1]):
-                g['_ignore'] = 1
-            else:
-                g['_ignore'] = 0
+        if len(gt['id']) == 0 and len(dt) == 0:
+            return [None] * len(areaRngs)
 
-        # sort dt highest score first, sort gt ignore last
-        gtind = np.argsort([g['_ignore'] for g in gt], kind='mergesort')
-        gt = [gt[i] for i in gtind]
+        # sort dt highest score first
         dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
         dt = [dt[i] for i in dtind[0:maxDet]]
-        iscrowd = [int(o['iscrowd']) for o in gt]
-
-        # load computed ious
-        ious = self.ious[imgId, catId][:, gtind] if len(self.ious[imgId, catId]) > 0 else self.ious[imgId, catId]
-
-        T = len(p.iouThrs)
-        G = len(gt)
-        D = len(dt)
-        gtm = np.zeros((T, G))
-        dtm = np.zeros((T, D))
-        gtIg = np.array([g['_ignore'] for g in gt])
-        dtIg = np.zeros((T, D))
-        # #### ad by hui ##############
-        ignore_gts = np.array([g['bbox'] for g in gt if g['_ignore']])
-        ignore_gts_idx = np.array([i for i, g in enumerate(gt) if g['_ignore']])
-        if len(ignore_gts_idx) > 0 and len(dt) > 0:
-            ignore_gts_area = np.array([g['area'] for g in gt if g['_ignore']])  # use area
-            ignore_ious = (ious.T[ignore_gts_idx]).T
-        ######################
-        if not len(ious) == 0:
-            for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t, 1 - 1e-10])
-                    m = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind, gind] > 0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m > -1 and gtIg[m] == 0 and gtIg[gind] == 1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind, gind] < iou:
-                            continue
-                        # if match successful and best so far, store appropriately
-                        iou = ious[dind, gind]
-                        m = gind
-                    # if match made store id of match for both dt and gt
-                    if m == -1:
-                        # #### ad by hui ##############
-                        if self.use_iod_for_ignore and len(ignore_gts) > 0:
-                            # time from 156.88s -> 79. s
-                            iods = self.IOD_by_IOU(np.array([d['bbox']]), None, ignore_gts_area,
-                                                   ignore_ious[dind:dind + 1, :])[0]
-                            # iods =self.IOD(np.array([d['bbox']]), ignore_gts)[0]
-                            idx = np.argmax(iods)
-                            if iods[idx] >= self.iod_th_of_iou_f(iou):
-                                # print('inside')
-                                m = ignore_gts_idx[idx]
-
-                                dtIg[tind, dind] = gtIg[m]
-                                dtm[tind, dind] = gt[m]['id']
-                                gtm[tind, m] = d['id']
-                            else:
-                                continue
-                        else:
-                            continue
-                        ######################
-                        ###continue
-                    dtIg[tind, dind] = gtIg[m]
-                    dtm[tind, dind] = gt[m]['id']
-                    gtm[tind, m] = d['id']
-        # set unmatched detections outside of area range to ignore
-        a = np.array([d['area'] < aRng[0] or d['area'] > aRng[1] for d in dt]).reshape((1, len(dt)))
-        dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T, 0)))
-        # store results for given image and category
-        return {
-            'image_id': imgId,
-            'category_id': catId,
-            'aRng': aRng,
-            'maxDet': maxDet,
-            'dtIds': [d['id'] for d in dt],
-            'gtIds': [g['id'] for g in gt],
-            'dtMatches': dtm,
-            'gtMatches': gtm,
-            'dtScores': [d['score'] for d in dt],
-            'gtIgnore': gtIg,
-            'dtIgnore': dtIg,
-        }
+        T, G, D = len(p.iouThrs), len(gt['id']), len(dt)
+        dt_ids = [d['id'] for d in dt]
+        dt_scores = [d['score'] for d in dt]
+        dt_area = np.array([d['area'] for d in dt])
+        gt_ids, gt_area, gt_ignore = gt['id'], gt['area'], gt['ignore']
+        gt_iscrowd = gt['iscrowd'].astype(int)
+        all_ious = self.ious[imgId, catId]
+        # iod of every (det, gt) is computed once and shared by all area ranges
+        all_iods = None
+        if self.use_iod_for_ignore and D > 0 and G > 0:
+            all_iods = self.IOD_by_IOU(np.array([d['bbox'] for d in dt]), None, gt_area, all_ious)
+
+        evalImgs = []
+        for aRng in areaRngs:
+            _ignore = np.logical_or(gt_ignore, np.logical_or(gt_area < aRng[0], gt_area > aRng[1])).astype(int)
+            # sort gt ignore last
+            gtind = np.argsort(_ignore, kind='mergesort')
+            gtIg = _ignore[gtind] if G > 0 else np.array([])
+            ious = all_ious[:, gtind] if len(all_ious) > 0 else all_ious
+
+            gtm = np.zeros((T, G))
+            dtm = np.zeros((T, D))
+            dtIg = np.zeros((T, D))
+            if not len(ious) == 0:
+                ignore_gts_idx = np.flatnonzero(gtIg)
+                ignore_iods = None
+                if all_iods is not None and len(ignore_gts_idx) > 0:
+                    ignore_iods = all_iods[:, gtind[ignore_gts_idx]]
+                gtm, dtm, dtIg = self.match_all_thresholds(
+                    ious, gtIg, gt_iscrowd[gtind], gt_ids[gtind], dt_ids, ignore_gts_idx, ignore_iods)
+            # set unmatched detections outside of area range to ignore
+            a = np.logical_or(dt_area < aRng[0], dt_area > aRng[1]).reshape((1, D))
+            dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T, 0)))
+            evalImgs.append({
+                'image_id': imgId,
+                'category_id': catId,
+                'aRng': aRng,
+                'maxDet': maxDet,
+                'dtIds': dt_ids,
+                'gtIds': gt_ids[gtind].tolist(),
+                'dtMatches': dtm,
+                'gtMatches': gtm,
+                'dtScores': dt_scores,
+                'gtIgnore': gtIg,
+                'dtIgnore': dtIg,
+            })
+        return evalImgs
 
     def summarize(self, print_func=print):
         '''
         Compute and display summary metrics for evaluation results.
         Note this functin can *only* be applied on the default parameter setting
+        print_func: None to not print the summary lines.
+        :return: self.metrics, OrderedDict of {name: value} of all summary lines, name is like 'AP', 'AP50_tiny1',
+            'AR@10', the iou (x100) is omitted for mean of all ious, the area for 'all', the maxDets for last maxDets.
         '''
         def float_equal(a, b):
             return np.abs(a-b) < 1e-6
@@ -334,7 +477,12 @@ class COCOExpandEval(COCOeval):
                 mean_s = -1
             else:
                 mean_s = np.mean(s[s>-1])
-            print_func(iStr.format(titleStr, typeStr, iouStr, areaRng, maxDets, mean_s))
+            name = ('AP' if ap == 1 else 'AR') + ('' if iouThr is None else '{:d}'.format(int(round(iouThr * 100))))
+            name += '' if areaRng == 'all' else '_{}'.format(areaRng)
+            name += '' if maxDets == p.maxDets[-1] else '@{}'.format(maxDets)
+            self.metrics[name] = float(mean_s)
+            if print_func is not None:
+                print_func(iStr.format(titleStr, typeStr, iouStr, areaRng, maxDets, mean_s))
             return mean_s
         # ###################################### changed by hui ###########################################
         def _summarizeDets_tiny():
@@ -398,7 +546,9 @@ class COCOExpandEval(COCOeval):
             else: summarize = _summarizeDets
         elif iouType == 'keypoints':
             summarize = _summarizeKps
+        self.metrics = OrderedDict()
         self.stats = summarize()
+        return self.metrics
 
     def evaluate(self):
         '''
@@ -424,29 +574,92 @@ class COCOExpandEval(COCOeval):
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
+        num_process = get_num_process(self.num_process)
+        if num_process > 1:
+            self.evaluate_in_shards(catIds, num_process)
+        else:
+            self.ious, self.evalImgs, _ = self.evaluate_shard(catIds, p.imgIds)
+        if self.iou_cache is not None:
+            self.iou_cache.save()
+
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def evaluate_shard(self, catIds, imgIds, gts=None, dts=None, gt_arrays=None):
+        """
+            compute ious and evalImgs of given categories and images, evalImgs are in the order of
+            catId -> areaRng -> imgId, same as evaluate().
+            gts/dts/gt_arrays: {(imgId, catId): anns/arrays} used in worker process instead of
+                self._gts/self._dts/self._gt_arrays.
+        """
+        p = self.params
+        if dts is not None:
+            self._gts, self._dts, self._gt_arrays = defaultdict(list, gts), defaultdict(list, dts), gt_arrays
         if p.iouType == 'segm' or p.iouType == 'bbox':
             computeIoU = self.computeIoU
         elif p.iouType == 'keypoints':
             computeIoU = self.computeOks
         self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in p.imgIds
+                        for imgId in imgIds
                         for catId in catIds}
 
         evaluateImg = self.evaluateImg
         maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in p.areaRng
-                 for imgId in p.imgIds
-             ]
-        # from multiprocplus import multiprocess_for
-        # eval_imgs_all_cat = multiprocess_for(self.evaluate_cat, [(catId,) for catId in catIds], debug_info=1)
-        # self.evalImgs = []
-        # [self.evalImgs.extend(eval_imgs) for eval_imgs in eval_imgs_all_cat]
-
-        self._paramsEval = copy.deepcopy(self.params)
-        toc = time.time()
-        print('DONE (t={:0.2f}s).'.format(toc-tic))
+        if self.batch_area_rng:
+            # [catId][imgId][areaRng] -> [catId][areaRng][imgId]
+            cat_img_evals = [[self.evaluateImgAllArea(imgId, catId, p.areaRng, maxDet) for imgId in imgIds]
+                             for catId in catIds]
+            evalImgs = [img_evals[ai]
+                        for cat_evals in cat_img_evals
+                        for ai in range(len(p.areaRng))
+                        for img_evals in cat_evals]
+        else:
+            evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
+                     for catId in catIds
+                     for areaRng in p.areaRng
+                     for imgId in imgIds
+                 ]
+        new_cache_entries = self.iou_cache.pop_new_entries() if (dts is not None and self.iou_cache is not None) else {}
+        return self.ious, evalImgs, new_cache_entries
+
+    def evaluate_in_shards(self, catIds, num_process):
+        """
+            split each category into contiguous image shards and evaluate (catId, shard) tasks in worker processes,
+            only anns of the shard are sent to the worker. evalImgs are merged back in the order of
+            catId -> areaRng -> imgId, so accumulate() and miss_fp_analysis.get_iou_match_results work as before.
+        """
+        p = self.params
+        shards = split_shards(p.imgIds, self.num_image_shards, num_process)
+        ann_catIds = p.catIds if not p.useCats else None
+        args_list = []
+        for catId in catIds:
+            for shard in shards:
+                cIds = [catId] if ann_catIds is None else ann_catIds
+                keys = [(imgId, cId) for imgId in shard for cId in cIds]
+                # gt ann dicts are only used by segm/keypoints iou
+                gts = {key: self._gts[key] for key in keys if key in self._gts} if p.iouType != 'bbox' else {}
+                dts = {key: self._dts[key] for key in keys if key in self._dts}
+                gt_arrays = {key: self._gt_arrays[key] for key in keys if key in self._gt_arrays}
+                args_list.append(([catId], shard, gts, dts, gt_arrays))
+
+        # worker only need params and flags, do not pickle COCO objects and anns of all images to each task
+        worker = copy.copy(self)
+        worker.cocoGt, worker.cocoDt, worker.prepared_gts = None, None, None
+        worker._gts, worker._dts, worker._gt_arrays = defaultdict(list), defaultdict(list), {}
+        worker.ious, worker.evalImgs, worker.eval = {}, [], {}
+        shards_res = multiprocess_map(worker.evaluate_shard, args_list, num_process=num_process)
+
+        self.ious, self.evalImgs = {}, []
+        for ci in range(len(catIds)):
+            cat_res = shards_res[ci * len(shards): (ci + 1) * len(shards)]
+            for ious, _, new_cache_entries in cat_res:
+                self.ious.update(ious)
+                if self.iou_cache is not None:
+                    self.iou_cache.update(new_cache_entries)
+            for ai in range(len(p.areaRng)):
+                for shard, (_, evalImgs, _) in zip(shards, cat_res):
+                    self.evalImgs.extend(evalImgs[ai * len(shard): (ai + 1) * len(shard)])
 
     def evaluate_cat(self, catId):
         p = self.params
@@ -1,6 +1,44 @@
 import numpy as np
 
 
+def chosen_max_precision_for_each_recall(recall, precision, eps=1e-10):
+    """
+        recall is ascending, for same recall (abs < eps), may have multiple precision, chosen the first one (the best one)
+        as precision, a recall is kept while abs(recall - last_kept_recall) >= eps.
+        return:
+            recall, precision, chosen_idx
+    """
+    recall, precision = np.asarray(recall), np.asarray(precision)
+    if len(recall) == 0:
+        return np.array([]), np.array([]), np.zeros((0,), dtype=np.int64)
+    diff = np.abs(np.diff(recall))
+    if abs(-1 - recall[0]) >= eps and not np.any(np.logical_and(diff > 0, diff < eps)):
+        # fast path: each recall equal to previous one or far from it, so compare with previous one is same as
+        # compare with last kept one.
+        chosen_idx = np.flatnonzero(np.concatenate([[True], diff >= eps]))
+    else:
+        last_r = -1
+        chosen_idx = []
+        for i, r in enumerate(recall):
+            if abs(last_r - r) < eps:
+                continue
+            last_r = r
+            chosen_idx.append(i)
+        chosen_idx = np.array(chosen_idx, dtype=np.int64)
+    return recall[chosen_idx], precision[chosen_idx], chosen_idx
+
+
+def choose_precision_of_recall_th(recall, precision, recall_th):
+    """
+        for each recall threshold, choose precision of the first recall >= threshold, 0 if no such recall.
+    """
+    recall, precision = np.asarray(recall), np.asarray(precision)
+    if len(recall) == 0:
+        return np.zeros((len(recall_th),))
+    inds = np.searchsorted(recall, recall_th, side='left')
+    return np.where(inds < len(recall), precision[np.minimum(inds, len(recall) - 1)], 0)
+
+
 class ClassifierMatcher(object):
     def __call__(self, predict, gt):
         """
@@ -74,21 +112,7 @@ class GeneralAP(object):
         """
             for same recall (abs < 1e-10), may have multiple precision, chosen the best one as precision
         """
-        last_r = -1
-        final_recall = []
-        final_precison = []
-        chosen_idx = []
-        for i, (r, p) in enumerate(zip(recall, precision)):
-            # for each recall choose the max precision
-            if abs(last_r - r) < 1e-10:
-                continue
-            final_recall.append(r)
-            final_precison.append(p)
-            last_r = r
-            chosen_idx.append(i)
-        recall = np.array(final_recall)
-        precision = np.array(final_precison)
-        return recall, precision, chosen_idx
+        return chosen_max_precision_for_each_recall(recall, precision)
 
     @staticmethod
     def cal_AP_of_recall(recall, precision, num_points=None, DEBUG=False):
@@ -97,8 +121,7 @@ class GeneralAP(object):
             recall_th = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01) + 1), endpoint=True)
         elif isinstance(num_points, int):
             recall_th = np.linspace(.0, 1.00, np.round((1.00 - .0) * (num_points-1)) + 1, endpoint=True)
-        inds = np.searchsorted(recall, recall_th, side='left')
-        choose_precisions = [precision[pi] if pi < len(recall) else 0 for pi in inds]
+        choose_precisions = choose_precision_of_recall_th(recall, precision, recall_th)
         if DEBUG:
             print("choose_precisions", choose_precisions)
         return np.sum(choose_precisions) / len(recall_th)
@@ -0,0 +1,133 @@
+"""
+    opt-in on-disk cache of per (imgId, catId) iou matrices, keyed by content hashes of the gt and det files.
+    the matrices are stored in one flat '<key>_values.npy' (opened as memmap) and a '<key>_index.json' of
+    {entry: [offset, rows, cols]}, so a re-run that only changes matching params (iouThrs, maxDets, areaRng,
+    ignore options) reads ious from disk instead of computing them again.
+    with cache_dir=None the cache is kept in memory only, it is used to share the ious of one (gt, det) pair
+    between evaluators (e.g. the AP evaluation and all MR setups in evaluate_tiny.evaluate_ap_mr).
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from huicv.evaluation.bbox_overlaps import xywh_iou_and_iod
+
+
+def file_hash(file_path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _py(v):
+    return v.item() if isinstance(v, np.generic) else v
+
+
+class IoUCache(object):
+    VERSION = 2
+
+    def __init__(self, cache_dir=None, key=None):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.values_path = os.path.join(cache_dir, '{}_values.npy'.format(key)) if cache_dir is not None else None
+        self.index_path = os.path.join(cache_dir, '{}_index.json'.format(key)) if cache_dir is not None else None
+        self.index = {}
+        self.values = None
+        self.new_entries = {}
+        self.load()
+
+    @staticmethod
+    def from_files(cache_dir, gt_file, det_file):
+        """
+            cache of (gt_file, det_file), the key is changed while the content of any file changed.
+        """
+        key = hashlib.sha1(json.dumps([IoUCache.VERSION, file_hash(gt_file), file_hash(det_file)]).encode())
+        return IoUCache(cache_dir, key.hexdigest()[:20])
+
+    def load(self):
+        if self.cache_dir is not None and os.path.exists(self.index_path) and os.path.exists(self.values_path):
+            self.index = json.load(open(self.index_path))
+            self.values = np.load(self.values_path, mmap_mode='r')
+
+    @staticmethod
+    def entry_key(imgId, catId, name):
+        return json.dumps([_py(imgId), _py(catId), name])
+
+    def get(self, imgId, catId, name):
+        """
+            return the cached matrix (a read only memmap view) or None if not cached.
+        """
+        entry = self.entry_key(imgId, catId, name)
+        if entry in self.new_entries:
+            return self.new_entries[entry]
+        if entry not in self.index:
+            return None
+        offset, rows, cols = self.index[entry]
+        return self.values[offset: offset + rows * cols].reshape((rows, cols))
+
+    def put(self, imgId, catId, name, value):
+        self.new_entries[self.entry_key(imgId, catId, name)] = np.asarray(value, dtype=np.float64)
+
+    def bbox_iou_and_iod(self, imgId, catId, dts, gts, name='bbox'):
+        """
+            dts: (D, 4) xywh boxes sorted by score, gts: (G, 4) xywh boxes
+            return (D, G) iou and iod matrices of all gts, read from cache or computed and put to cache,
+                the ious of crowd/ignore gts are chosen from them by the caller.
+        """
+        ious, iods = self.get(imgId, catId, name + '_iou'), self.get(imgId, catId, name + '_iod')
+        if ious is None or iods is None or ious.shape != (len(dts), len(gts)):
+            ious, iods = xywh_iou_and_iod(dts, gts)
+            self.put(imgId, catId, name + '_iou', ious)
+            self.put(imgId, catId, name + '_iod', iods)
+        return ious, iods
+
+    def pop_new_entries(self):
+        new_entries, self.new_entries = self.new_entries, {}
+        return new_entries
+
+    def update(self, new_entries):
+        self.new_entries.update(new_entries)
+
+    def save(self):
+        """
+            append new entries to the values file, the file is written to a temp path and then renamed,
+            so a reader will never see a half written cache.
+        """
+        if self.cache_dir is None or len(self.new_entries) == 0:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        old_size = 0 if self.values is None else len(self.values)
+        new_size = sum(v.size for v in self.new_entries.values())
+        tmp_values_path = self.values_path + '.tmp.npy'
+        values = np.lib.format.open_memmap(tmp_values_path, mode='w+', dtype=np.float64,
+                                           shape=(old_size + new_size,))
+        if old_size > 0:
+            values[:old_size] = self.values
+        offset = old_size
+        index = dict(self.index)
+        for entry, v in self.new_entries.items():
+            values[offset: offset + v.size] = v.reshape(-1)
+            index[entry] = [offset, v.shape[0], v.shape[1]]
+            offset += v.size
+        values.flush()
+        del values
+        self.values = None
+        os.replace(tmp_values_path, self.values_path)
+        tmp_index_path = self.index_path + '.tmp'
+        json.dump(index, open(tmp_index_path, 'w'))
+        os.replace(tmp_index_path, self.index_path)
+        self.new_entries = {}
+        self.load()
+
+    def __getstate__(self):
+        # only pass the paths to worker process, the memmap is opened again there
+        state = self.__dict__.copy()
+        state['values'], state['index'], state['new_entries'] = None, {}, {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
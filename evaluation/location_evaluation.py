@@ -2,9 +2,11 @@ import copy
 
 import numpy as np
 from copy import deepcopy
+import os
 import sys
 import time
-from multiprocplus import multiprocess_for
+from huicv.evaluation.multi_process import multiprocess_map, split_shards
+from huicv.evaluation.general_ap import chosen_max_precision_for_each_recall, choose_precision_of_recall_th
 
 # python huicv/evaluation/location_evaluation.py \
 # '/home/ubuntu/dataset/visDrone/coco_fmt_annotations/VisDrone2018-DET-val-person.json' \
@@ -52,33 +54,59 @@ class GTMatcher(object):
                 keep[j] = 0  # remove gt j
                 left_g -= 1
 
-    def _match_to_regluar_gt_no_repeat_v2(self, V, v_th, scores, M):
-        equal_score_edge = [0]
-        last_score = scores[0]
-        for i in range(1, len(scores)):
-            if abs(scores[i] - last_score) < self.eps:
+    def _equal_score_group(self, scores):
+        """
+            group id of each det (scores are descend sorted), dets with almost equal scores are in a group,
+            a new group start while abs(scores[i] - score_of_group_start) >= eps.
+        """
+        if len(scores) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        diff = np.abs(np.diff(scores))
+        if not np.any(np.logical_and(diff > 0, diff < self.eps)):
+            # fast path: each score equal to previous one or far from it, so equal to group start or far from it
+            return np.concatenate([[0], np.cumsum(diff >= self.eps)])
+        group = np.empty((len(scores),), dtype=np.int64)
+        g, last_score = 0, scores[0]
+        for i in range(len(scores)):
+            if abs(scores[i] - last_score) >= self.eps:
+                g, last_score = g + 1, scores[i]
+            group[i] = g
+        return group
+
+    def _greedy_match_candidates(self, det_ids, gt_ids, values, scores, M):
+        """
+            greedy match of candidate (det, gt) pairs, each pair have values[k] = V[det_ids[k], gt_ids[k]] >= v_th.
+            pairs are sorted once by (equal score group of det, -value, det_id, gt_id), so dets of higher score
+            match first, and in a group of equal scores the pair of max value match first, then a pair is matched
+            if both of det and gt have not been matched before. cost O(P log P), P is number of candidate pairs.
+        """
+        if len(det_ids) == 0:
+            return
+        group = self._equal_score_group(scores)
+        order = np.lexsort((gt_ids, det_ids, -values, group[det_ids]))
+        det_ids, gt_ids = det_ids[order].tolist(), gt_ids[order].tolist()
+        matched_det, matched_gt = set(), set()
+        for det_id, gt_id in zip(det_ids, gt_ids):
+            if det_id in matched_det or gt_id in matched_gt:
                 continue
-            equal_score_edge.append(i)
-            last_score = scores[i]
-        equal_score_edge.append(len(scores))
-
-        keep_det = np.array([1] * V.shape[0]).reshape((-1, 1))
-        keep_gt = np.array([1] * V.shape[1]).reshape((1, -1))
-        left_gt = V.shape[1]
-        for i in range(len(equal_score_edge) - 1):
-            if left_gt == 0: break
-            s, e = equal_score_edge[i], equal_score_edge[i + 1]
-            for _ in range(s, e):
-                if left_gt == 0: break
-                idx = np.argmax(((V[s:e] * keep_det[s:e]) * keep_gt).reshape((-1,)))
-                det_id = s + idx // V.shape[1]
-                gt_id = idx % V.shape[1]
-
-                if V[det_id, gt_id] >= v_th:
-                    M[det_id] = gt_id
-                    keep_det[det_id] = 0
-                    keep_gt[:, gt_id] = 0
-                    left_gt -= 1
+            M[det_id] = gt_id
+            matched_det.add(det_id)
+            matched_gt.add(gt_id)
+
+    def _match_to_regluar_gt_no_repeat_v3(self, V, v_th, scores, M):
+        """
+            we assume the input det result have been descend sorted by score, match each det to at most one gt
+            and each gt to at most one det, dets of higher score match first, and for dets with equal score
+            (abs diff < eps), the (det, gt) pair with max value match first. only pairs with V >= v_th are matched.
+            args:
+                V: value of det box with gt box, shape = (len(D), len(G))
+                v_th: the threshold for macth
+                scores: descend sorted scores of dets
+            return:
+                M: matched gt id for each det, shape=len(D)
+        """
+        det_ids, gt_ids = np.nonzero(V >= v_th)
+        self._greedy_match_candidates(det_ids, gt_ids, V[det_ids, gt_ids], scores, M)
 
     def _match_as_ignore_det(self, V, v_th, start_gt_idx, M, ID):
         """
@@ -101,30 +129,68 @@ class GTMatcher(object):
         """
             D must be sorted by det_scores
         """
+        V = self.cal_value(D, G) if len(G) > 0 else None
+        IV = self.cal_value(D, IG) if len(IG) > 0 else None
+        return self.match_by_value(V, IV, det_scores, v_th, multi_match_not_false_alarm, multi_match_v_th)
+
+    def match_by_value(self, V, IV, det_scores, v_th, multi_match_not_false_alarm, multi_match_v_th=None):
+        """
+            V: value of dets with regular gts, None if no regular gt
+            IV: value of dets with ignored gts, None if no ignored gt
+        """
         if multi_match_v_th is None:
             multi_match_v_th = v_th
 
-        M = np.array([BACKGROUND] * len(D))
-        ID = np.array([False] * len(D))  # ignore det
+        M = np.array([BACKGROUND] * len(det_scores))
+        ID = np.array([False] * len(det_scores))  # ignore det
 
-        if len(G) > 0:
-            V = self.cal_value(D, G)
+        if V is not None:
             if self.LOG is not None: print('V(D, G):\n', V, file=self.LOG)
             # match det to regular gt with no repeated
             # self._match_to_regluar_gt_no_repeat(V, v_th, M)
-            self._match_to_regluar_gt_no_repeat_v2(V, v_th, det_scores, M)
+            self._match_to_regluar_gt_no_repeat_v3(V, v_th, det_scores, M)
 
-        if len(IG) > 0:
-            IV = self.cal_value(D, IG)
+        if IV is not None:
             if self.LOG is not None: print('V(D, IG):\n', IV, file=self.LOG)
             # match det to ignore gt with repeated
-            self._match_as_ignore_det(IV, v_th, len(G), M, ID)
+            self._match_as_ignore_det(IV, v_th, V.shape[1] if V is not None else 0, M, ID)
 
-        if multi_match_not_false_alarm and len(G) > 0:
+        if multi_match_not_false_alarm and V is not None:
             # if do not treat multi det that match same gt as false alarm, set them as ignore det
             self._match_as_ignore_det(V, multi_match_v_th, 0, M, ID)
         return M, ID, det_scores
 
+    def get_value_th(self, match_th):
+        """
+            transform match threshold to threshold of V, for bbox detection it is IOU threshold itself.
+        """
+        return match_th
+
+    def cal_cached_value(self, D, gts, max_match_th):
+        """
+            value of D with all gts of an image (regular and ignored), it is calculated once and reused for
+            every (size_range, match_th, maxDets) condition by match_with_cached_value, D is sorted by score and
+            any prefix D[:maxDets] can be used.
+        """
+        if len(gts) == 0:
+            return np.empty((len(D), 0))
+        return self.cal_value(D, gts)
+
+    def match_with_cached_value(self, cached_value, det_scores, gts_ignore, match_th, multi_match_not_false_alarm,
+                                multi_match_th=None):
+        """
+            same result as __call__(D, det_scores, gts[~gts_ignore], gts[gts_ignore], ...), but use value returned by
+            cal_cached_value, det_scores can be a prefix of scores of cached D.
+        """
+        V = cached_value[:len(det_scores)]
+        v_th = self.get_value_th(match_th)
+        multi_match_v_th = self.get_value_th(multi_match_th) if multi_match_th is not None else v_th
+        return self.match_by_value(
+            V[:, np.logical_not(gts_ignore)] if np.sum(np.logical_not(gts_ignore)) > 0 else None,
+            V[:, gts_ignore] if np.sum(gts_ignore) > 0 else None,
+            det_scores, v_th, multi_match_not_false_alarm, multi_match_v_th
+        )
+
 
 # class BoxMatcher(GTMatcher):
 #     def cal_value(self, dets, gts):
@@ -132,6 +198,14 @@ class GTMatcher(object):
 
 
 class PointMatcher(GTMatcher):
+    def __init__(self, eps=1e-8, LOG=None, block_size=4096):
+        """
+            block_size: max number of det rows computed in one broadcast of cal_value, peak memory of
+                cal_value is about block_size * len(gts) * 2 float, set None or <= 0 to compute all dets in one pass.
+        """
+        super(PointMatcher, self).__init__(eps, LOG)
+        self.block_size = block_size
+
     def cal_value(self, dets, gts):
         """
             L2 distance matcher for (xc, yc) det and (xc, yc, w, h) gt.
@@ -142,18 +216,168 @@ class PointMatcher(GTMatcher):
                 return V
         """
         det_values = np.empty((len(dets), len(gts)))
-        for i in range(len(dets)):
-            d = (dets[i].reshape((1, -1)) - gts[:, :2]) / gts[:, 2:]
-            det_values[i, :] = (d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])
+        block_size = len(dets) if self.block_size is None or self.block_size <= 0 else self.block_size
+        gts_center, gts_wh = gts[None, :, :2], gts[None, :, 2:]
+        for s in range(0, len(dets), max(block_size, 1)):
+            # (block, 1, 2) - (1, G, 2) => (block, G, 2), same element-wise ops (and dtype) as row-by-row version
+            d = (dets[s:s + block_size, None, :] - gts_center) / gts_wh
+            det_values[s:s + block_size] = (d[..., 0] * d[..., 0] + d[..., 1] * d[..., 1])
         return 1 / (1 + det_values)
 
+    def get_value_th(self, dis_th):
+        return 1 / (dis_th * dis_th + 1)
+
     def __call__(self, dets, det_scores, gts, ignore_gts, dis_th, multi_match_not_false_alarm, multi_match_dis_th=None):
-        v_th = 1 / (dis_th * dis_th + 1)
-        multi_match_v_th = 1 / (multi_match_dis_th * multi_match_dis_th + 1) if multi_match_dis_th is not None else v_th
+        v_th = self.get_value_th(dis_th)
+        multi_match_v_th = self.get_value_th(multi_match_dis_th) if multi_match_dis_th is not None else v_th
         if self.LOG: print('v_th:', v_th, file=self.LOG)
         return super(PointMatcher, self).__call__(
             dets, det_scores, gts, ignore_gts, v_th, multi_match_not_false_alarm, multi_match_v_th
         )
+
+    def match_with_cached_value(self, cached_value, det_scores, gts_ignore, dis_th, multi_match_not_false_alarm,
+                                multi_match_dis_th=None):
+        return super(PointMatcher, self).match_with_cached_value(
+            cached_value, det_scores, gts_ignore, dis_th, multi_match_not_false_alarm, multi_match_dis_th
+        )
+
+
+class SparsePointMatcher(PointMatcher):
+    """
+        same match result as PointMatcher, but do not build the dense (len(dets), len(gts)) V matrix.
+        a uniform grid is built over gt centers for each image, each gt is put into all cells covered by
+        its match region (xc +- dis_th * w, yc +- dis_th * h), and each det only look up the cell it falls in,
+        so only candidate pairs near to each other are calculated, which is much faster for crowd images.
+        cell size is the median extent of gt match regions, a gt much larger than it (cover more than
+        max_cells_per_gt cells) is not put into the grid, but paired with every det, so a few huge gts in
+        an image of tiny gts do not blow up the grid.
+    """
+
+    def __init__(self, eps=1e-8, LOG=None, margin=1e-3, max_cells_per_gt=64):
+        """
+            margin: relative and absolute enlargement of gt match region when build the grid, candidate pairs
+                are filtered by exact V >= v_th after look up, so the margin only avoid missing pairs on border.
+            max_cells_per_gt: gt covers more cells than it is checked with all dets instead of put into the grid.
+        """
+        super(SparsePointMatcher, self).__init__(eps, LOG)
+        self.margin = margin
+        self.max_cells_per_gt = max_cells_per_gt
+
+    def cal_candidate_pairs(self, dets, gts, dis_th):
+        """
+            return:
+                det_ids, gt_ids: candidate pairs that have normalized distance within dis_th (with margin)
+        """
+        empty = np.zeros((0,), dtype=np.int64)
+        if len(dets) == 0 or len(gts) == 0:
+            return empty, empty
+        centers = gts[:, :2].astype(np.float64)
+        radius = gts[:, 2:].astype(np.float64) * dis_th * (1 + self.margin) + self.margin  # (G, 2)
+        cell_size = np.maximum(np.median(2 * radius, axis=0), self.margin)  # (2,)
+        origin = (centers - radius).min(axis=0)
+
+        lo = np.floor((centers - radius - origin) / cell_size).astype(np.int64)  # (G, 2)
+        hi = np.floor((centers + radius - origin) / cell_size).astype(np.int64)
+        num_cells = hi - lo + 1
+        grid_h = hi[:, 1].max() + 1
+
+        # expand each gt to all cells it covered, except large gts
+        n = num_cells[:, 0] * num_cells[:, 1]
+        large_gt_ids = np.nonzero(n > self.max_cells_per_gt)[0]
+        n[large_gt_ids] = 0
+        gt_rep = np.repeat(np.arange(len(gts)), n)
+        k = np.arange(len(gt_rep)) - np.repeat(np.cumsum(n) - n, n)
+        cell_x = lo[gt_rep, 0] + k % num_cells[gt_rep, 0]
+        cell_y = lo[gt_rep, 1] + k // num_cells[gt_rep, 0]
+        order = np.argsort(cell_x * grid_h + cell_y, kind='stable')
+        gt_keys, gt_rep = (cell_x * grid_h + cell_y)[order], gt_rep[order]
+
+        det_cells = np.floor((dets.astype(np.float64) - origin) / cell_size).astype(np.int64)
+        det_keys = det_cells[:, 0] * grid_h + det_cells[:, 1]
+        left = np.searchsorted(gt_keys, det_keys, side='left')
+        count = np.searchsorted(gt_keys, det_keys, side='right') - left
+        count[np.logical_or(det_cells < 0, det_cells >= [hi[:, 0].max() + 1, grid_h]).any(axis=1)] = 0
+
+        det_ids = np.repeat(np.arange(len(dets)), count)
+        k = np.arange(len(det_ids)) - np.repeat(np.cumsum(count) - count, count)
+        gt_ids = gt_rep[np.repeat(left, count) + k]
+        if len(large_gt_ids) > 0:
+            det_ids = np.concatenate([det_ids, np.repeat(np.arange(len(dets)), len(large_gt_ids))])
+            gt_ids = np.concatenate([gt_ids, np.tile(large_gt_ids, len(dets))])
+        return det_ids, gt_ids
+
+    def cal_sparse_value(self, dets, gts, dis_th):
+        """
+            return:
+                det_ids, gt_ids, values: pairs with values = V[det_ids, gt_ids] >= 1/(dis_th*dis_th+1),
+                    V is the same as PointMatcher.cal_value(dets, gts)
+        """
+        det_ids, gt_ids = self.cal_candidate_pairs(dets, gts, dis_th)
+        if len(det_ids) == 0:
+            return det_ids, gt_ids, np.zeros((0,), dtype=np.float64)
+        d = (dets[det_ids] - gts[gt_ids, :2]) / gts[gt_ids, 2:]
+        values = 1 / (1 + (d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]).astype(np.float64))
+        keep = values >= self.get_value_th(dis_th)
+        return det_ids[keep], gt_ids[keep], values[keep]
+
+    def _sparse_match_as_ignore_det(self, det_ids, gt_ids, values, v_th, start_gt_idx, M, ID):
+        """
+            sparse version of _match_as_ignore_det, choose the max value (first gt if tie) pair for each unmatched det.
+        """
+        keep = np.logical_and(values >= v_th, M[det_ids] == BACKGROUND)
+        det_ids, gt_ids, values = det_ids[keep], gt_ids[keep], values[keep]
+        order = np.lexsort((gt_ids, -values, det_ids))
+        det_ids, gt_ids = det_ids[order], gt_ids[order]
+        first = np.ones((len(det_ids),), dtype=np.bool_)
+        first[1:] = det_ids[1:] != det_ids[:-1]
+        M[det_ids[first]] = gt_ids[first] + start_gt_idx
+        ID[det_ids[first]] = True
+
+    def __call__(self, dets, det_scores, gts, ignore_gts, dis_th, multi_match_not_false_alarm, multi_match_dis_th=None):
+        max_dis_th = max(dis_th, multi_match_dis_th) if multi_match_dis_th is not None else dis_th
+        pairs = self.cal_sparse_value(dets, gts, max_dis_th)
+        ignore_pairs = self.cal_sparse_value(dets, ignore_gts, dis_th)
+        return self.match_by_pairs(pairs, len(gts), ignore_pairs, det_scores, dis_th,
+                                   multi_match_not_false_alarm, multi_match_dis_th)
+
+    def match_by_pairs(self, pairs, num_gts, ignore_pairs, det_scores, dis_th, multi_match_not_false_alarm,
+                       multi_match_dis_th=None):
+        """
+            pairs: (det_ids, gt_ids, values) of dets with regular gts
+            ignore_pairs: (det_ids, gt_ids, values) of dets with ignored gts
+        """
+        v_th = self.get_value_th(dis_th)
+        multi_match_v_th = self.get_value_th(multi_match_dis_th) if multi_match_dis_th is not None else v_th
+
+        M = np.array([BACKGROUND] * len(det_scores))
+        ID = np.array([False] * len(det_scores))  # ignore det
+
+        det_ids, gt_ids, values = pairs
+        keep = values >= v_th
+        self._greedy_match_candidates(det_ids[keep], gt_ids[keep], values[keep], det_scores, M)
+
+        self._sparse_match_as_ignore_det(*ignore_pairs, v_th, num_gts, M, ID)
+
+        if multi_match_not_false_alarm:
+            self._sparse_match_as_ignore_det(det_ids, gt_ids, values, multi_match_v_th, 0, M, ID)
+        return M, ID, det_scores
+
+    def cal_cached_value(self, dets, gts, max_match_th):
+        return self.cal_sparse_value(dets, gts, max_match_th)
+
+    def match_with_cached_value(self, cached_value, det_scores, gts_ignore, dis_th, multi_match_not_false_alarm,
+                                multi_match_dis_th=None):
+        det_ids, gt_ids, values = cached_value
+        keep_det = det_ids < len(det_scores)
+        # index of each gt in regular gts / ignored gts
+        regular_gt_idx = np.cumsum(np.logical_not(gts_ignore)) - 1
+        ignore_gt_idx = np.cumsum(gts_ignore) - 1
+        is_ignore = gts_ignore[gt_ids]
+        keep, ignore_keep = np.logical_and(keep_det, ~is_ignore), np.logical_and(keep_det, is_ignore)
+        pairs = (det_ids[keep], regular_gt_idx[gt_ids[keep]], values[keep])
+        ignore_pairs = (det_ids[ignore_keep], ignore_gt_idx[gt_ids[ignore_keep]], values[ignore_keep])
+        return self.match_by_pairs(pairs, len(gts_ignore) - np.sum(gts_ignore), ignore_pairs, det_scores, dis_th,
+                                   multi_match_not_false_alarm, multi_match_dis_th)
 # part1: matcher, to get matched gt/ignored gt of each det result end ###############################
 
 
@@ -183,20 +407,8 @@ def cal_recall_precision(match_gts, dets_score, len_pos):
     recall = TP / (len_pos + 1e-12)
     precision = TP / np.arange(1, len(is_pos) + 1)
 
-    last_r = -1
-    final_recall = []
-    final_precison = []
-    chosen_idx = []
-    for i, (r, p) in enumerate(zip(recall, precision)):
-        # for each recall choose the max precision
-        if abs(last_r - r) < 1e-10:
-            continue
-        final_recall.append(r)
-        final_precison.append(p)
-        last_r = r
-        chosen_idx.append(i)
-    recall = np.array(final_recall)
-    precision = np.array(final_precison)
+    # for each recall choose the max precision
+    recall, precision, chosen_idx = chosen_max_precision_for_each_recall(recall, precision)
 
     if len(recall) == 0:  # no det
         recall, precision = pr_of_no_det(len_pos)
@@ -213,33 +425,72 @@ def cat(arrays):
         return np.concatenate(arrays)
 
 
-def match_and_cal_recall_precision(all_dets, all_dets_score, all_gts, all_gts_ignore, match_th, maxDets,
-                                  matcher, matcher_kwargs={}):
+def build_value_cache(all_dets, all_dets_score, all_gts, max_match_th, max_maxDets, matcher, matcher_kwargs={}):
     """
-        match and cal recall and precision of single condition, which means
-            single class, single size_range, single match_th
-        called by evaluate_in_multi_condition
+        sort dets of each image by score once and calculate value of dets with all gts of the image once,
+        so that all (size_range, match_th, maxDets) conditions reuse them, called by evaluate_in_multi_condition.
+        return:
+            {"dets_score": {img_id: sorted dets score}, "values": {img_id: cached value returned by matcher}},
+            image without det is not in the cache.
     """
     assert (set(all_gts.keys()) | set(all_dets.keys())) == set(all_gts.keys()), "all det image must in gt"
-    all_match_gts, all_sorted_dets_scores, all_dets_keep, len_pos = {}, {}, {}, 0
+    multi_match_th = matcher_kwargs.get('multi_match_dis_th', None)
+    if multi_match_th is not None and matcher_kwargs.get('multi_match_not_false_alarm', False):
+        max_match_th = max(max_match_th, multi_match_th)
+    cache = {"dets_score": {}, "values": {}}
     for i in all_gts:
-        gts, gts_ignore = all_gts[i], all_gts_ignore[i]
         dets, dets_score = all_dets[i], all_dets_score[i]
-
-        len_pos += len(gts_ignore) - np.sum(gts_ignore)
         if len(dets) > 0:
-            G, IG = gts[np.logical_not(gts_ignore)], gts[gts_ignore]
             # D = descend_sort_by_score(D)
             idx = np.argsort(-dets_score)
-            dets, dets_score = dets[idx][:maxDets], dets_score[idx][:maxDets]
+            dets, dets_score = dets[idx][:max_maxDets], dets_score[idx][:max_maxDets]
+            cache["dets_score"][i] = dets_score
+            cache["values"][i] = matcher.cal_cached_value(dets, all_gts[i], max_match_th)
+    return cache
 
-            match_gts, dets_ignore, dets_score = matcher(dets, dets_score, G, IG, match_th, **matcher_kwargs)
-            all_match_gts[i] = match_gts
-            all_sorted_dets_scores[i] = dets_score
-            all_dets_keep[i] = np.logical_not(dets_ignore)
+
+def match_with_value_cache(cache, all_gts_ignore, match_th, maxDets, matcher, matcher_kwargs={}):
+    """
+        return: matches of single condition, a dict contains
+            match_gts, dets_score, dets_keep: dict of image id, only for image with det
+            num_pos: dict of image id, number of regular gt of each image
+    """
+    all_match_gts, all_sorted_dets_scores, all_dets_keep = {}, {}, {}
+    for i, cached_value in cache["values"].items():
+        match_gts, dets_ignore, dets_score = matcher.match_with_cached_value(
+            cached_value, cache["dets_score"][i][:maxDets], all_gts_ignore[i], match_th, **matcher_kwargs)
+        all_match_gts[i] = match_gts
+        all_sorted_dets_scores[i] = dets_score
+        all_dets_keep[i] = np.logical_not(dets_ignore)
+    num_pos = {i: len(gts_ignore) - np.sum(gts_ignore) for i, gts_ignore in all_gts_ignore.items()}
+    return {"match_gts": all_match_gts, "dets_score": all_sorted_dets_scores, "dets_keep": all_dets_keep,
+            "num_pos": num_pos}
+
+
+def merge_matches(matches_list):
+    """
+        merge matches of single condition returned by match_with_value_cache of different image shards,
+        the image order of merged matches is the order of matches_list.
+    """
+    merged = {"match_gts": {}, "dets_score": {}, "dets_keep": {}, "num_pos": {}}
+    for matches in matches_list:
+        for key in merged:
+            merged[key].update(matches[key])
+    return merged
+
+
+def cal_recall_precision_of_matches(matches, images_id):
+    """
+        images_id: concatenate order of images, keep it same to get same recall and precision
+    """
+    len_pos = 0
+    for i in images_id:
+        len_pos += matches["num_pos"][i]
 
     # filter ignore det out when evaluate AP
-    images_id = list(all_match_gts.keys())
+    all_match_gts, all_sorted_dets_scores, all_dets_keep = \
+        matches["match_gts"], matches["dets_score"], matches["dets_keep"]
+    images_id = [img_id for img_id in images_id if img_id in all_match_gts]
     match_gts_array = cat([all_match_gts[img_id][all_dets_keep[img_id]] for img_id in images_id])
     dets_scores_array = cat([all_sorted_dets_scores[img_id][all_dets_keep[img_id]] for img_id in images_id])
 
@@ -247,44 +498,32 @@ def match_and_cal_recall_precision(all_dets, all_dets_score, all_gts, all_gts_ig
     return {"recall": recall, "precision": precision}
 
 
-def match_and_cal_recall_precision_of_every_image(all_dets, all_dets_score, all_gts, all_gts_ignore,
-                                                 match_th, maxDets, matcher,
-                                                  matcher_kwargs={}):
-    """
-      debug function: it is a function to cal recall and precision for each image
-      try to measure
-    """
-    assert (set(all_gts.keys()) | set(all_dets.keys())) == set(all_gts.keys()), "all det image must in gt"
+def cal_recall_precision_of_every_image_matches(matches, images_id):
     all_recall, all_precision = {}, {}
-    for i in all_gts:  # for each image
-        gts, gts_ignore = all_gts[i], all_gts_ignore[i]
-        dets, dets_score = all_dets[i], all_dets_score[i]
-
-        if len(dets) > 0:
-            G, IG = gts[np.logical_not(gts_ignore)], gts[gts_ignore]
-            # D = descend_sort_by_score(D)
-            idx = np.argsort(-dets_score)
-            dets, dets_score = dets[idx][:maxDets], dets_score[idx][:maxDets]
+    for i in images_id:  # for each image
+        num_G = matches["num_pos"][i]
 
-            match_gts, dets_ignore, dets_score = matcher(dets, dets_score, G, IG, match_th, **matcher_kwargs)
-            dets_keep = np.logical_not(dets_ignore)
+        if i in matches["match_gts"]:
+            match_gts, dets_score, dets_keep = matches["match_gts"][i], matches["dets_score"][i], \
+                                               matches["dets_keep"][i]
 
-            if len(G) > 0 and (np.sum(dets_keep) == 0):
+            if num_G > 0 and (np.sum(dets_keep) == 0):
                 # miss
                 all_recall[i] = [0.]
                 all_precision[i] = [-2]
-            if len(G) == 0 and (np.sum(dets_keep) > 0):
+            if num_G == 0 and (np.sum(dets_keep) > 0):
                 # flase alarm
                 all_recall[i] = [0]
                 all_precision[i] = [-3]
-            elif len(G) == 0 and (np.sum(dets_keep) == 0):
+            elif num_G == 0 and (np.sum(dets_keep) == 0):
                 all_recall[i] = [1.]
                 all_precision[i] = [2.]
-            elif len(G) > 0 and np.sum(dets_keep) > 0:
-                recall, precision = cal_recall_precision(match_gts[dets_keep], dets_score[dets_keep], len(G))
+            elif num_G > 0 and np.sum(dets_keep) > 0:
+                # python int num_G keeps per-image recall in float32 as TP, numpy int would promote it to float64
+                recall, precision = cal_recall_precision(match_gts[dets_keep], dets_score[dets_keep], int(num_G))
                 all_recall[i] = recall
                 all_precision[i] = precision
-        elif len(G) > 0:
+        elif num_G > 0:
             # miss gt
             all_recall[i] = [0.]
             all_precision[i] = [-2]
@@ -295,47 +534,110 @@ def match_and_cal_recall_precision_of_every_image(all_dets, all_dets_score, all_
     return {"all_recall": all_recall, "all_precision": all_precision}
 
 
-def evaluate_in_multi_condition(all_dets, all_dets_score, all_gts, all_gts_ignore,
-                                match_th_list, size_ranges, maxDets_list, matcher,
-                                matcher_kwargs={}, evaluate_img_separate=False):
+def match_and_cal_recall_precision(all_dets, all_dets_score, all_gts, all_gts_ignore, match_th, maxDets,
+                                  matcher, matcher_kwargs={}, cache=None):
     """
-        evaluate_img_seperate: if True, then for each image, calculate recall and precision, only for analysis
+        match and cal recall and precision of single condition, which means
+            single class, single size_range, single match_th
+        cache: returned by build_value_cache, build here if not given
+    """
+    if cache is None:
+        cache = build_value_cache(all_dets, all_dets_score, all_gts, match_th, maxDets, matcher, matcher_kwargs)
+    matches = match_with_value_cache(cache, all_gts_ignore, match_th, maxDets, matcher, matcher_kwargs)
+    return cal_recall_precision_of_matches(matches, list(all_gts.keys()))
+
+
+def match_and_cal_recall_precision_of_every_image(all_dets, all_dets_score, all_gts, all_gts_ignore,
+                                                 match_th, maxDets, matcher,
+                                                  matcher_kwargs={}, cache=None):
+    """
+      debug function: it is a function to cal recall and precision for each image
+      try to measure
+    """
+    if cache is None:
+        cache = build_value_cache(all_dets, all_dets_score, all_gts, match_th, maxDets, matcher, matcher_kwargs)
+    matches = match_with_value_cache(cache, all_gts_ignore, match_th, maxDets, matcher, matcher_kwargs)
+    return cal_recall_precision_of_every_image_matches(matches, list(all_gts.keys()))
+
+
+def get_size_range_ignore(all_gts, all_gts_ignore, size_ranges):
+    """
+        set gt that size out of [min_size, max_size) as ignored gt, sizes of all images are compared in one pass.
+        return:
+            list of dict, all_gts_ignore of each size range
+    """
+    images_id = list(all_gts_ignore.keys())
+    sizes = cat([np.sqrt(all_gts[i][:, -1] * all_gts[i][:, -2]) if len(all_gts[i]) > 0
+                 else np.zeros((0,), dtype=np.float32) for i in images_id])
+    ignores = cat([np.asarray(all_gts_ignore[i], dtype=np.bool_) for i in images_id]).astype(np.bool_)
+    split_idx = np.cumsum([len(all_gts_ignore[i]) for i in images_id])[:-1]
+    res = []
+    for min_size, max_size in size_ranges:
+        size_ignore = np.logical_or(ignores, np.logical_or(sizes >= max_size, sizes < min_size))
+        res.append(dict(zip(images_id, np.split(size_ignore, split_idx))))
+    return res
+
+
+def match_in_multi_condition(all_dets, all_dets_score, all_gts, all_gts_ignore,
+                             match_th_list, size_ranges, maxDets_list, matcher, matcher_kwargs={}):
+    """
+        match phase of evaluate_in_multi_condition, value of dets and gts is calculated once for all conditions
+        by build_value_cache. images are independent, so it can run on any shard of images.
+        return:
+            matches of each (size_range, match_th, maxDets) condition, in the same order as
+            evaluate_in_multi_condition results.
+    """
+    cache = build_value_cache(all_dets, all_dets_score, all_gts, max(match_th_list), max(maxDets_list),
+                              matcher, matcher_kwargs)
+    all_size_range_ignore = get_size_range_ignore(all_gts, all_gts_ignore, size_ranges)
+    all_matches = []
+    for si, all_gts_ignore_of_size in enumerate(all_size_range_ignore):  # choose a size_range
+        for mi, match_th in enumerate(match_th_list):
+            for mdi, maxDets in enumerate(maxDets_list):
+                all_matches.append(match_with_value_cache(
+                    cache, all_gts_ignore_of_size, match_th, maxDets, matcher, matcher_kwargs))
+    return all_matches
+
+
+def cal_recall_precision_in_multi_condition(all_matches, images_id, match_th_list, size_ranges, maxDets_list,
+                                            evaluate_img_separate=False):
+    """
+        recall phase of evaluate_in_multi_condition, all_matches is returned by match_in_multi_condition
+        (or merged from image shards by merge_matches).
     """
     res = {
         'match_th_idx': [],
         'size_range_idx': [],
         'maxDets_idx': []
     }
-    for si, (min_size, max_size) in enumerate(size_ranges):  # choose a size_range
+    conditions = [(si, mi, mdi) for si in range(len(size_ranges))
+                  for mi in range(len(match_th_list)) for mdi in range(len(maxDets_list))]
+    for (si, mi, mdi), matches in zip(conditions, all_matches):
+        if not evaluate_img_separate:
+            results = cal_recall_precision_of_matches(matches, images_id)
+        else:
+            results = cal_recall_precision_of_every_image_matches(matches, images_id)
+        res['match_th_idx'].append(mi)
+        res['size_range_idx'].append(si)
+        res['maxDets_idx'].append(mdi)
+        for key, value in results.items():
+            if key not in res:
+                res[key] = [value]
+            else:
+                res[key].append(value)
+    return res
 
-        # set gt that size out of [min_size, max_size) as ignored gt
-        all_gts_ignore_copy = deepcopy(all_gts_ignore)
-        for i in all_gts_ignore_copy:
-            gts = all_gts[i]
-            if len(gts) <= 0: continue
-            gts_ignore = all_gts_ignore_copy[i]
-            sizes = np.sqrt((gts[:, -1] * gts[:, -2]))
-            gts_ignore[np.logical_or(sizes >= max_size, sizes < min_size)] = True
 
-        for mi, match_th in enumerate(match_th_list):
-            for mdi, maxDets in enumerate(maxDets_list):
-                if not evaluate_img_separate:
-                    results = match_and_cal_recall_precision(
-                        all_dets, all_dets_score, all_gts, all_gts_ignore_copy, match_th, maxDets,
-                        matcher, matcher_kwargs)
-                else:
-                    results = match_and_cal_recall_precision_of_every_image(
-                        all_dets, all_dets_score, all_gts, all_gts_ignore_copy, match_th, maxDets,
-                        matcher, matcher_kwargs)
-                res['match_th_idx'].append(mi)
-                res['size_range_idx'].append(si)
-                res['maxDets_idx'].append(mdi)
-                for key, value in results.items():
-                    if key not in res:
-                        res[key] = [value]
-                    else:
-                        res[key].append(value)
-    return res
+def evaluate_in_multi_condition(all_dets, all_dets_score, all_gts, all_gts_ignore,
+                                match_th_list, size_ranges, maxDets_list, matcher,
+                                matcher_kwargs={}, evaluate_img_separate=False):
+    """
+        evaluate_img_seperate: if True, then for each image, calculate recall and precision, only for analysis
+    """
+    all_matches = match_in_multi_condition(all_dets, all_dets_score, all_gts, all_gts_ignore,
+                                           match_th_list, size_ranges, maxDets_list, matcher, matcher_kwargs)
+    return cal_recall_precision_in_multi_condition(all_matches, list(all_gts.keys()), match_th_list, size_ranges,
+                                                   maxDets_list, evaluate_img_separate)
 # part2: recall precision cal, to get recall and precision from match result end ###############################
 
 
@@ -351,10 +653,71 @@ def group_by(dicts, key):
     return res
 
 
+def group_by_columns(keys, columns):
+    """
+        columnar version of group_by, group each array of columns by keys with one stable argsort and np.split.
+        args:
+            keys: shape=(N,)
+            columns: {name: array with shape (N, ...)}
+        return:
+            unique keys in order of first occurrence (same order as group_by),
+            {key: {name: array of the key}}, items of each key keep the input order.
+    """
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return [], {}
+    uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    rank = np.empty((len(uniq),), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(uniq))
+    key_rank = rank[inverse]
+    order = np.argsort(key_rank, kind='stable')
+    split_idx = np.cumsum(np.bincount(key_rank, minlength=len(uniq)))[:-1]
+    ordered_keys = uniq[np.argsort(first, kind='stable')].tolist()
+    splits = {name: np.split(np.asarray(col)[order], split_idx) for name, col in columns.items()}
+    return ordered_keys, {key: {name: splits[name][i] for name in columns} for i, key in enumerate(ordered_keys)}
+
+
+def save_columns_by_category(columns, cate_ids, save_prefix):
+    """
+        sort columns by category_id (stable) and save each column to a .npy file, so that each category
+        is a contiguous range [start, end) of rows and can be loaded by load_columns with mmap.
+        return:
+            paths: {name: .npy path}
+            ranges: [(start, end) of each category in cate_ids]
+    """
+    cate_rank = {cate_id: i for i, cate_id in enumerate(cate_ids)}
+    rank = np.array([cate_rank.get(c, len(cate_ids)) for c in columns['category_id'].tolist()], dtype=np.int64)
+    order = np.argsort(rank, kind='stable')
+    ends = np.cumsum(np.bincount(rank, minlength=len(cate_ids) + 1))[:len(cate_ids)]
+    starts = np.concatenate([[0], ends[:-1]]) if len(ends) > 0 else ends
+    paths = {}
+    for name, col in columns.items():
+        paths[name] = f"{save_prefix}_{name}.npy"
+        np.save(paths[name], np.ascontiguousarray(np.asarray(col)[order]))
+    return paths, [(int(s), int(e)) for s, e in zip(starts, ends)]
+
+
+def load_columns(paths, start, end):
+    """
+        load rows [start, end) of columns saved by save_columns_by_category with mmap, only the rows are read.
+    """
+    return {name: np.load(path, mmap_mode='r')[start:end] for name, path in paths.items()}
+
+
 def get_center_w_h(x, y, w, h):
     return [x + (w - 1) / 2, y + (h - 1) / 2, w, h]
 
 
+def get_center_w_h_array(bboxes):
+    """
+        vectorized get_center_w_h, bboxes: (x, y, w, h) with shape (N, 4)
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape((-1, 4))
+    x, y, w, h = bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3]
+    return np.stack([x + (w - 1) / 2, y + (h - 1) / 2, w, h], axis=1)
+
+
 class LocationEvaluator(object):
     """
     example:
@@ -378,6 +741,11 @@ class LocationEvaluator(object):
         det_jd = json.load(open(det_file))
         LocationEvaluator.add_center_from_bbox_if_no_point(det_jd)
         res = evaluator(det_jd, gt_jd)
+
+        # third call way, columnar arrays (no list of dict needed)
+        det_columns = dict(image_id=..., category_id=..., point=..., score=...)   # (N,), (N,), (N, 2), (N,)
+        gt_columns = dict(image_id=..., category_id=..., bbox=..., ignore=...)    # (M,), (M,), (M, 4), (M,)
+        res = evaluator.evaluate_multi_class_columnar(det_columns, gt_columns, gt_jd['categories'])
     --------------------------------------------------------------------
     return:
     --------------------------------------------------------------------
@@ -395,10 +763,24 @@ class LocationEvaluator(object):
 
     def __init__(self, evaluate_img_separate=False, class_wise=False, use_ignore_attr=True,
                  location_param={}, matcher_kwargs=dict(multi_match_not_false_alarm=False),
-                 num_process=-1, print_func=print, **kwargs):
+                 num_process=-1, print_func=print, use_spatial_index=False, parallel_axis='category',
+                 num_image_shards=None, transport='pickle', memmap_dir=None, **kwargs):
         """
             evaluate_img_separate: if True, then for each image, calculate recall and precision, only set True for analysis
+            use_spatial_index: if True, use SparsePointMatcher to only calculate det/gt pairs near to each other,
+                same result as default PointMatcher but much faster on crowd images.
+            parallel_axis: 'category' or 'image', run categories in multiprocess, or run categories one by one and
+                shard images of each category in multiprocess (for single class dataset, such as TinyPerson).
+            num_image_shards: number of image shards while parallel_axis='image', default 4 * num_process.
+            transport: 'pickle' or 'memmap', how to pass dets/gts of each category to worker process.
+                'pickle' pass columnar arrays of each category as pickled arguments;
+                'memmap' save columnar arrays (sorted by category) to .npy files once, and workers only receive
+                the file paths and index range of the category, arrays are loaded by np.load(mmap_mode='r'),
+                so no pickle of dets/gts and no per-process copy of the whole dataset.
+            memmap_dir: directory to save .npy files while transport='memmap', default a temporary directory.
         """
+        assert parallel_axis in ['category', 'image'], parallel_axis
+        assert transport in ['pickle', 'memmap'], transport
         self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         if not class_wise:
             self.matchThs = [0.5, 1.0, 2.0]
@@ -428,12 +810,16 @@ class LocationEvaluator(object):
         self.evaluate_img_separate = evaluate_img_separate
         self.use_ignore_attr = use_ignore_attr
 
-        self.matcher = PointMatcher()
+        self.matcher = SparsePointMatcher() if use_spatial_index else PointMatcher()
         self.matcher_kwargs = matcher_kwargs
 
         self.gt_jd = None
         self.num_process = num_process
         self.print_func = print_func
+        self.parallel_axis = parallel_axis
+        self.num_image_shards = num_image_shards
+        self.transport = transport
+        self.memmap_dir = memmap_dir
 
     def __call__(self, det_jd, gt_jd):
         try:
@@ -448,66 +834,166 @@ class LocationEvaluator(object):
         return self.evaluate_multi_class(det_jd, gt_jd)
 
     def evaluate_multi_class(self, det_jd, gt_jd):
-        # gt_jd_common = {key: value for key, value in gt_jd.items() if key != 'annotations'}
-        gt_annos_all_cate = {cat["id"]: [] for cat in gt_jd['categories']}
-        gt_annos_all_cate.update(group_by(gt_jd["annotations"], "category_id"))
-        det_jd_all_cate = {cat["id"]: [] for cat in gt_jd['categories']}
-        det_jd_all_cate.update(group_by(det_jd, "category_id"))
+        det_columns = self.dets_to_columns(det_jd)
+        gt_columns = self.gts_to_columns(gt_jd["annotations"])
+        return self.evaluate_multi_class_columnar(det_columns, gt_columns, gt_jd['categories'])
+
+    def dets_to_columns(self, det_jd):
+        """
+            transform list of det dict to columnar arrays:
+                {"image_id": (N,), "category_id": (N,), "point": (N, 2), "score": (N,)}
+        """
+        return {
+            "image_id": np.array([det['image_id'] for det in det_jd]),
+            "category_id": np.array([det['category_id'] for det in det_jd]),
+            "point": np.array([det['point'] for det in det_jd], dtype=np.float32).reshape((-1, 2)),
+            "score": np.array([det['score'] for det in det_jd], dtype=np.float32),
+        }
+
+    def gts_to_columns(self, gt_annos):
+        """
+            transform list of gt annotation dict to columnar arrays:
+                {"image_id": (M,), "category_id": (M,), "bbox": (M, 4) of (x, y, w, h), "ignore": (M,)}
+        """
+        return {
+            "image_id": np.array([gt['image_id'] for gt in gt_annos]),
+            "category_id": np.array([gt['category_id'] for gt in gt_annos]),
+            "bbox": np.array([gt['bbox'] for gt in gt_annos], dtype=np.float64).reshape((-1, 4)),
+            "ignore": self.get_ignore(gt_annos),
+        }
+
+    def evaluate_multi_class_columnar(self, det_columns, gt_columns, categories):
+        """
+            entry of columnar input, det_columns and gt_columns are format as dets_to_columns/gts_to_columns return,
+            categories: gt_jd['categories']
+        """
+        if self.transport == 'memmap':
+            return self.evaluate_multi_class_memmap(det_columns, gt_columns, categories)
+        gt_columns_all_cate = group_by_columns(gt_columns['category_id'], gt_columns)[1]
+        det_columns_all_cate = group_by_columns(det_columns['category_id'], det_columns)[1]
+        gt_columns_all_cate = [gt_columns_all_cate.get(cate['id'], self.empty_columns(gt_columns))
+                               for cate in categories]
+        det_columns_all_cate = [det_columns_all_cate.get(cate['id'], self.empty_columns(det_columns))
+                                for cate in categories]
 
         self.print_func("start evaluation in multiprocess ................")
         tic = time.time()
         # from huicv.utils.multi_process import multiprocess_run
         # costs = self.get_time_cost_of_all_cate(gt_annos_all_cate, det_jd_all_cate)
         # print(sorted(costs))
-        res_set = multiprocess_for(
-            self.evaluate_single_class,
-            [(idx, det_jd_all_cate[cate['id']], gt_annos_all_cate[cate['id']])
-             for idx, cate in enumerate(gt_jd['categories'])],
-            share_data_list=[], num_process=self.num_process, debug_info=1,
-            cost_list=self.get_time_cost_of_all_cate(gt_annos_all_cate, det_jd_all_cate),
-            cost_rate_per_process=3
+        # while parallel in images, categories are evaluated one by one
+        res_set = multiprocess_map(
+            self.evaluate_single_class_columnar,
+            [(idx, det_columns_all_cate[idx], gt_columns_all_cate[idx]) for idx in range(len(categories))],
+            num_process=self.num_process if self.parallel_axis == 'category' else 1,
+            cost_list=self.get_time_cost_of_all_cate_columnar(gt_columns_all_cate, det_columns_all_cate),
+            print_func=self.print_func
         )
-        # faied run in multi process, run in single process instead
-        if len(res_set) == 0:
-            self.print_func("multi-process run failed, run in single process.")
-            res_set = [
-                self.evaluate_single_class(
-                    idx, det_jd_all_cate[cate['id']], gt_annos_all_cate[cate['id']])
-                for idx, cate in enumerate(gt_jd['categories'])]
         self.print_func(f"finish evaluation, {time.time()-tic}s")
-        assert len(res_set) == len(gt_jd['categories']), f"{len(res_set)} vs {len(gt_jd['categories'])}"
+        assert len(res_set) == len(categories), f"{len(res_set)} vs {len(categories)}"
+        return res_set
+
+    def evaluate_multi_class_memmap(self, det_columns, gt_columns, categories):
+        """
+            same as evaluate_multi_class_columnar, but pass dets/gts to workers by .npy memmap files.
+        """
+        import tempfile
+        # image_id maybe str, encode it as int to save in memmap, encode do not change the group order.
+        image_ids = None
+        if any(len(col) > 0 and col.dtype.kind not in 'iuf' for col in [det_columns['image_id'], gt_columns['image_id']]):
+            num_det = len(det_columns['image_id'])
+            image_ids, codes = np.unique(np.concatenate([det_columns['image_id'].astype(object),
+                                                         gt_columns['image_id'].astype(object)]), return_inverse=True)
+            codes = codes.reshape(-1)
+            det_columns = dict(det_columns, image_id=codes[:num_det])
+            gt_columns = dict(gt_columns, image_id=codes[num_det:])
+
+        cate_ids = [cate['id'] for cate in categories]
+        with tempfile.TemporaryDirectory(dir=self.memmap_dir) as memmap_dir:
+            det_paths, det_ranges = save_columns_by_category(det_columns, cate_ids, os.path.join(memmap_dir, 'det'))
+            gt_paths, gt_ranges = save_columns_by_category(gt_columns, cate_ids, os.path.join(memmap_dir, 'gt'))
+
+            self.print_func("start evaluation in multiprocess (memmap) ................")
+            tic = time.time()
+            args_list = [(idx, det_paths, det_ranges[idx], gt_paths, gt_ranges[idx]) for idx in range(len(categories))]
+            cost_list = [(3.0 if (de - ds) * (ge - gs) > 0 else 0.2) + (de - ds) / 20000 * 3 + (ge - gs) / 10000 * 3
+                         for (ds, de), (gs, ge) in zip(det_ranges, gt_ranges)]
+            res_set = multiprocess_map(
+                self.evaluate_single_class_memmap, args_list,
+                num_process=self.num_process if self.parallel_axis == 'category' else 1,
+                cost_list=cost_list, print_func=self.print_func
+            )
+            self.print_func(f"finish evaluation, {time.time()-tic}s")
+        assert len(res_set) == len(categories), f"{len(res_set)} vs {len(categories)}"
+
+        if image_ids is not None and self.evaluate_img_separate:
+            for res in res_set:
+                for key in ['all_recall', 'all_precision']:
+                    res[key] = [{image_ids[code]: v for code, v in d.items()} for d in res.get(key, [])]
         return res_set
 
+    def evaluate_single_class_memmap(self, idx, det_paths, det_range, gt_paths, gt_range):
+        det_columns = load_columns(det_paths, *det_range)
+        gt_columns = load_columns(gt_paths, *gt_range)
+        return self.evaluate_single_class_columnar(idx, det_columns, gt_columns)
+
+    @staticmethod
+    def empty_columns(columns):
+        return {name: col[:0] for name, col in columns.items()}
+
     def evaluate_single_class(self, idx, det_jd, gt_annos):
+        return self.evaluate_single_class_columnar(idx, self.dets_to_columns(det_jd), self.gts_to_columns(gt_annos))
+
+    def evaluate_single_class_columnar(self, idx, det_columns, gt_columns):
         # tic = time.time()
-        res = self.evaluate_while_no_det_or_gt(len(det_jd), len(gt_annos))
+        res = self.evaluate_while_no_det_or_gt(len(det_columns['score']), len(gt_columns['ignore']))
         if res is None:
-            # g_det_jd = {img['id']: [] for img in gt_jd['images']}
-            # g_det_jd.update(group_by(det_jd, "image_id"))
-            # g_gt_jd = {img['id']: [] for img in gt_jd['images']}
-            # g_gt_jd.update(group_by(gt_annos, 'image_id'))
-            g_det_jd = group_by(det_jd, "image_id")
-            g_gt_jd = group_by(gt_annos, 'image_id')
-            g_gt_jd.update({img_id: [] for img_id in g_det_jd if img_id not in g_gt_jd})
-            g_det_jd.update({img_id: [] for img_id in g_gt_jd if img_id not in g_det_jd})
-
-            # all_dets_bbox = {img_id: [det['bbox'] for det in dets] for img_id, dets in g_det_jd.items()}
-            all_dets_point = {img_id: np.array([det['point'] for det in dets], dtype=np.float32) for img_id, dets in
-                              g_det_jd.items()}
-            all_dets_score = {img_id: np.array([det['score'] for det in dets], dtype=np.float32) for img_id, dets in
-                              g_det_jd.items()}
-
-            all_gts_centerwh = {img_id: np.array([get_center_w_h(*gt['bbox']) for gt in gts], dtype=np.float32) for
-                                img_id, gts in g_gt_jd.items()}
-            all_gts_ignore = {img_id:  self.get_ignore(gts) for img_id, gts in g_gt_jd.items()}
-
-            res = evaluate_in_multi_condition(all_dets_point, all_dets_score, all_gts_centerwh, all_gts_ignore,
-                                              self.matchThs, self.size_ranges, self.maxDets,
-                                              self.matcher, self.matcher_kwargs, self.evaluate_img_separate)
+            gt_img_ids, g_gt = group_by_columns(gt_columns['image_id'], dict(bbox=gt_columns['bbox'],
+                                                                              ignore=gt_columns['ignore']))
+            det_img_ids, g_det = group_by_columns(det_columns['image_id'], dict(point=det_columns['point'],
+                                                                                 score=det_columns['score']))
+            # image order same as group_by(gt_annos) then images only have det
+            img_ids = gt_img_ids + [img_id for img_id in det_img_ids if img_id not in g_gt]
+            empty_gt = dict(bbox=np.zeros((0, 4)), ignore=np.zeros((0,), dtype=np.bool_))
+            empty_det = dict(point=np.zeros((0, 2), dtype=np.float32), score=np.zeros((0,), dtype=np.float32))
+
+            all_dets_point = {img_id: g_det.get(img_id, empty_det)['point'] for img_id in img_ids}
+            all_dets_score = {img_id: g_det.get(img_id, empty_det)['score'] for img_id in img_ids}
+            all_gts_centerwh = {img_id: get_center_w_h_array(g_gt.get(img_id, empty_gt)['bbox']).astype(np.float32)
+                                for img_id in img_ids}
+            all_gts_ignore = {img_id: g_gt.get(img_id, empty_gt)['ignore'].astype(np.bool_) for img_id in img_ids}
+
+            if self.parallel_axis == 'image':
+                all_matches = self.match_in_image_shards(img_ids, all_dets_point, all_dets_score,
+                                                         all_gts_centerwh, all_gts_ignore)
+            else:
+                all_matches = match_in_multi_condition(all_dets_point, all_dets_score, all_gts_centerwh,
+                                                       all_gts_ignore, self.matchThs, self.size_ranges,
+                                                       self.maxDets, self.matcher, self.matcher_kwargs)
+            res = cal_recall_precision_in_multi_condition(all_matches, img_ids, self.matchThs, self.size_ranges,
+                                                          self.maxDets, self.evaluate_img_separate)
         # self.print_func(f"finished {idx}-th task (category: {cate['id']}, {time.time() - tic}s,"
         #                 f" gt: {len(gt_annos)}, det: {len(single_class_det_jd)})")
         return res
 
+    def match_in_image_shards(self, img_ids, all_dets_point, all_dets_score, all_gts_centerwh, all_gts_ignore):
+        """
+            shard images into contiguous chunks and match each chunk in worker processes, the merged matches keep
+            the image order of img_ids, so the result is the same for any num_process/num_image_shards.
+        """
+        shards = split_shards(img_ids, self.num_image_shards, self.num_process)
+        args_list = [({i: all_dets_point[i] for i in shard}, {i: all_dets_score[i] for i in shard},
+                      {i: all_gts_centerwh[i] for i in shard}, {i: all_gts_ignore[i] for i in shard})
+                     for shard in shards]
+        shards_matches = multiprocess_map(self.match_image_shard, args_list, num_process=self.num_process,
+                                          print_func=self.print_func)
+        return [merge_matches([matches[k] for matches in shards_matches]) for k in range(len(shards_matches[0]))]
+
+    def match_image_shard(self, all_dets_point, all_dets_score, all_gts_centerwh, all_gts_ignore):
+        return match_in_multi_condition(all_dets_point, all_dets_score, all_gts_centerwh, all_gts_ignore,
+                                        self.matchThs, self.size_ranges, self.maxDets,
+                                        self.matcher, self.matcher_kwargs)
+
     def evaluate_while_no_det_or_gt(self, num_det, num_gt):
         res = {
             'match_th_idx': [],
@@ -613,6 +1099,19 @@ class LocationEvaluator(object):
             id_cost.append(cost)
         return id_cost
 
+    def get_time_cost_of_all_cate_columnar(self, gt_columns_all_cate, det_columns_all_cate):
+        """
+            same as get_time_cost_of_all_cate, but input is list of columnar gts/dets of each category
+        """
+        id_cost = []
+        for gt_columns, det_columns in zip(gt_columns_all_cate, det_columns_all_cate):
+            num_gt, num_det = len(gt_columns['image_id']), len(det_columns['image_id'])
+            # if no det or no gt, only cost 0.2s due to early return, if not take 3.0s base time
+            cost = 3.0 if num_gt * num_det > 0 else 0.2
+            cost += num_det / 20000 * 3 + num_gt / 10000 * 3
+            id_cost.append(cost)
+        return id_cost
+
     @staticmethod
     def get_AP_of_recall(recall, precision, recall_th=None, DEBUG=False):
         assert len(recall) == len(precision), ""
@@ -620,8 +1119,7 @@ class LocationEvaluator(object):
             recall_th = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
         elif isinstance(recall_th, int):
             recall_th = np.linspace(.0, 1.00, np.round((1.00 - .0) * recall_th) + 1, endpoint=True)
-        inds = np.searchsorted(recall, recall_th, side='left')
-        choose_precisions = [precision[pi] if pi < len(recall) else 0 for pi in inds]
+        choose_precisions = choose_precision_of_recall_th(recall, precision, recall_th)
         if DEBUG:
             print("choose_precisions", choose_precisions)
         return np.sum(choose_precisions) / len(recall_th)
@@ -647,6 +1145,109 @@ class LocationEvaluator(object):
                 det['point'] = [x + (w - 1) / 2, y + (h - 1) / 2]
 
 
+class IncrementalLocationEvaluator(LocationEvaluator):
+    """
+    evaluate while inference, each image is matched as soon as its dets arrive, and only compact match arrays
+    of each image are kept, the result is same as LocationEvaluator if dets are updated in the same order.
+    example:
+    --------------------------------------------------------------------
+        evaluator = IncrementalLocationEvaluator(gt_jd, matcher_kwargs=dict(multi_match_not_false_alarm=False))
+        for batch in data_loader:
+            dets = model(batch)   # list of det dict (with point or bbox) or columnar dict as dets_to_columns return
+            evaluator.update(dets)
+        res = evaluator.compute()
+        evaluator.summarize(res, gt_jd)
+    --------------------------------------------------------------------
+    all dets of an image must be passed in one update.
+    """
+
+    def __init__(self, gt_jd, **kwargs):
+        super(IncrementalLocationEvaluator, self).__init__(**kwargs)
+        self.reset(gt_jd)
+
+    def reset(self, gt_jd=None):
+        """
+            clear all updated dets, gt_jd is parsed once here and reused by all update.
+        """
+        if gt_jd is None:
+            gt_jd = self.gt_jd
+        try:
+            from pycocotools.coco import COCO
+            if isinstance(gt_jd, COCO):
+                gt_jd = gt_jd.dataset
+        except ModuleNotFoundError as e:
+            pass
+        self.gt_jd = gt_jd
+        self.cate_idx = {cate['id']: idx for idx, cate in enumerate(gt_jd['categories'])}
+
+        gt_columns = self.gts_to_columns(gt_jd['annotations'])
+        gt_columns_all_cate = group_by_columns(gt_columns['category_id'], gt_columns)[1]
+        self.gt_img_ids, self.gts_centerwh, self.gts_ignore, self.num_gts = [], [], [], []
+        for cate in gt_jd['categories']:
+            columns = gt_columns_all_cate.get(cate['id'], self.empty_columns(gt_columns))
+            img_ids, g_gt = group_by_columns(columns['image_id'], dict(bbox=columns['bbox'], ignore=columns['ignore']))
+            self.gt_img_ids.append(img_ids)
+            self.gts_centerwh.append({i: get_center_w_h_array(g['bbox']).astype(np.float32) for i, g in g_gt.items()})
+            self.gts_ignore.append({i: g['ignore'].astype(np.bool_) for i, g in g_gt.items()})
+            self.num_gts.append(len(columns['ignore']))
+
+        num_cate = len(gt_jd['categories'])
+        self.num_dets = [0] * num_cate
+        self.det_only_img_ids = [[] for _ in range(num_cate)]  # image have det but no gt, in order of update
+        self.updated_img_ids = [set() for _ in range(num_cate)]
+        self.all_matches = [[] for _ in range(num_cate)]  # matches of each update
+
+    def update(self, det_jd):
+        """
+            det_jd: dets of a batch of images, list of det dict or columnar dict as dets_to_columns return.
+        """
+        if not isinstance(det_jd, dict):
+            LocationEvaluator.add_center_from_bbox_if_no_point(det_jd)
+            det_jd = self.dets_to_columns(det_jd)
+        cate_ids, det_columns_all_cate = group_by_columns(det_jd['category_id'], det_jd)
+        for cate_id in cate_ids:
+            if cate_id not in self.cate_idx:
+                continue
+            idx, det_columns = self.cate_idx[cate_id], det_columns_all_cate[cate_id]
+            img_ids, g_det = group_by_columns(det_columns['image_id'],
+                                              dict(point=det_columns['point'], score=det_columns['score']))
+            assert len(self.updated_img_ids[idx] & set(img_ids)) == 0, "all dets of an image must in one update"
+            self.updated_img_ids[idx].update(img_ids)
+            self.det_only_img_ids[idx].extend([i for i in img_ids if i not in self.gts_ignore[idx]])
+            self.num_dets[idx] += len(det_columns['score'])
+
+            all_gts_centerwh = {i: self.gts_centerwh[idx].get(i, np.zeros((0, 4), dtype=np.float32)) for i in img_ids}
+            all_gts_ignore = {i: self.gts_ignore[idx].get(i, np.zeros((0,), dtype=np.bool_)) for i in img_ids}
+            self.all_matches[idx].append(match_in_multi_condition(
+                {i: g_det[i]['point'] for i in img_ids}, {i: g_det[i]['score'] for i in img_ids},
+                all_gts_centerwh, all_gts_ignore, self.matchThs, self.size_ranges, self.maxDets,
+                self.matcher, self.matcher_kwargs))
+
+    def compute(self):
+        """
+            return: same format as LocationEvaluator.__call__
+        """
+        res_set = []
+        for idx in range(len(self.gt_img_ids)):
+            res = self.evaluate_while_no_det_or_gt(self.num_dets[idx], self.num_gts[idx])
+            if res is None:
+                # images have gt but no det, only number of regular gts is needed
+                img_ids = [i for i in self.gt_img_ids[idx] if i not in self.updated_img_ids[idx]]
+                empty_dets = {i: np.zeros((0, 2), dtype=np.float32) for i in img_ids}
+                no_det_matches = match_in_multi_condition(
+                    empty_dets, {i: np.zeros((0,), dtype=np.float32) for i in img_ids},
+                    {i: self.gts_centerwh[idx][i] for i in img_ids}, {i: self.gts_ignore[idx][i] for i in img_ids},
+                    self.matchThs, self.size_ranges, self.maxDets, self.matcher, self.matcher_kwargs)
+                all_matches = self.all_matches[idx] + [no_det_matches]
+                all_matches = [merge_matches([matches[k] for matches in all_matches])
+                               for k in range(len(no_det_matches))]
+                res = cal_recall_precision_in_multi_condition(
+                    all_matches, self.gt_img_ids[idx] + self.det_only_img_ids[idx], self.matchThs,
+                    self.size_ranges, self.maxDets, self.evaluate_img_separate)
+            res_set.append(res)
+        return res_set
+
+
 def main(args):
     if isinstance(args.matchThs, float):
         args.matchThs = [args.matchThs]
@@ -655,6 +1256,7 @@ def main(args):
     if args.task == 1:
         location_kwargs = dict(
             class_wise=args.class_wise,
+            use_spatial_index=args.use_spatial_index,
             matcher_kwargs=dict(multi_match_not_false_alarm=False),
             location_param=dict(
                 matchThs=args.matchThs,  # [0.5, 1.0, 2.0],
@@ -681,6 +1283,7 @@ def main(args):
     # ############################################# 2. find score with given recall
     elif args.task == 2:
         location_kwargs = dict(
+            use_spatial_index=args.use_spatial_index,
             matcher_kwargs=dict(multi_match_not_false_alarm=False),
             location_param=dict(
                 matchThs=args.matchThs,  # [0.5, 1.0, 2.0],
@@ -796,6 +1399,7 @@ if __name__ == '__main__':
     parser.add_argument('--maxDets', default=[300], nargs='+', type=int)
     parser.add_argument('--class_wise', default=False, type=bool)
     parser.add_argument('--task', default=1, type=int)
+    parser.add_argument('--use-spatial-index', action='store_true', help='use grid index to match det and gt')
     parser.add_argument('--given-recall', default=[0.9], nargs='+', type=float, help='arg for task==2')
     args = parser.parse_args()
     main(args)
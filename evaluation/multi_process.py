@@ -0,0 +1,74 @@
+"""
+    run evaluation tasks in worker processes, shared by LocationEvaluator, COCOExpandEval, evaluate_tiny and
+    the Cityscapes MR evaluator.
+"""
+import multiprocessing
+import multiprocessing.pool
+import pickle
+import traceback
+import numpy as np
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+# failures to start the pool or to send tasks/results between processes, tasks are run in main process instead.
+# exceptions raised by func itself are caught in worker (see _run_task), so they never fall in here.
+POOL_ERRORS = (OSError, pickle.PicklingError, TypeError, AttributeError, multiprocessing.pool.MaybeEncodingError)
+
+
+def get_num_process(num_process):
+    """
+        num_process < 0 means all cpus, 0 and 1 means run in main process, at most the number of cpus.
+    """
+    if num_process < 0:
+        return multiprocessing.cpu_count()
+    return max(min(num_process, multiprocessing.cpu_count()), 1)
+
+
+def split_shards(items, num_shards=None, num_process=-1):
+    """
+        split items into at most num_shards contiguous non-empty shards (num_process * 4 if num_shards is None),
+        concatenate the shards gives items back.
+    """
+    if num_shards is None:
+        num_shards = get_num_process(num_process) * 4
+    return [[items[i] for i in shard] for shard in np.array_split(np.arange(len(items)), max(num_shards, 1))
+            if len(shard) > 0]
+
+
+def _run_task(func, args):
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def multiprocess_map(func, args_list, num_process=-1, cost_list=None, print_func=print):
+    """
+        [func(*args) for args in args_list] in worker processes, results keep the order of args_list.
+        cost_list: estimated cost of each task, tasks of larger cost are sent to workers first.
+        if the pool can not be started or tasks/results can not be pickled, the exception is logged and all tasks are
+        run in main process instead, while an exception raised by func in worker is raised as WorkerError.
+    """
+    num_process = min(get_num_process(num_process), len(args_list))
+    if num_process <= 1:
+        return [func(*args) for args in args_list]
+
+    order = list(range(len(args_list)))
+    if cost_list is not None:
+        order = sorted(order, key=lambda i: -cost_list[i])
+    try:
+        with multiprocessing.Pool(num_process) as pool:
+            outs = pool.starmap(_run_task, [(func, args_list[i]) for i in order], chunksize=1)
+    except POOL_ERRORS as e:
+        print_func("multi-process run failed ({}: {}), run in single process.".format(type(e).__name__, e))
+        return [func(*args) for args in args_list]
+
+    results = [None] * len(args_list)
+    for i, (ok, res) in zip(order, outs):
+        if not ok:
+            raise WorkerError("{}-th task failed in worker process:\n{}".format(i, res))
+        results[i] = res
+    return results
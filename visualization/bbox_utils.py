@@ -1,4 +1,5 @@
 import numpy as np
+from huicv.evaluation.bbox_overlaps import bbox_overlaps
 
 def insect_boxes(box1, boxes):
     sx1, sy1, sx2, sy2 = box1[:4]
@@ -20,25 +21,16 @@ def bbox_area(boxes):
     return s
 
 
-def bbox_iod(dets, gts, eps=1e-12):
-    iods = np.zeros(shape=(dets.shape[0], gts.shape[0]), dtype=np.float32)
-    dareas = bbox_area(dets)
-    for i, (darea, det) in enumerate(zip(dareas, dets)):
-        idet = insect_boxes(det, gts)
-        iarea = bbox_area(idet)
-        iods[i, :] = iarea / (darea + eps)
-    return iods
-
-
-def bbox_iou(dets, gts, eps=1e-12):
-    ious = np.zeros(shape=(dets.shape[0], gts.shape[0]), dtype=np.float32)
-    dareas = bbox_area(dets)
-    gareas = bbox_area(gts)
-    for i, (darea, det) in enumerate(zip(dareas, dets)):
-        idet = insect_boxes(det, gts)
-        iarea = bbox_area(idet)
-        ious[i, :] = iarea / (darea + gareas - iarea + eps)
-    return ious
+def bbox_iod(dets, gts, eps=1e-12, block_size=4096, use_numba=False):
+    return bbox_overlaps(dets, gts, 'iod', eps, block_size=block_size, use_numba=use_numba)
+
+
+def bbox_iou(dets, gts, eps=1e-12, block_size=4096, use_numba=False):
+    return bbox_overlaps(dets, gts, 'iou', eps, block_size=block_size, use_numba=use_numba)
+
+
+def bbox_iog(dets, gts, eps=1e-12, block_size=4096, use_numba=False):
+    return bbox_overlaps(dets, gts, 'iog', eps, block_size=block_size, use_numba=use_numba)
 
 
 def inv_normalize_box(bboxes, w, h):